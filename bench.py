@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from sync import Sync, SyncItem
+
+SCENARIOS = ['tiny', 'huge', 'deep', 'mixed', 'filelist', 'fanout']
+
+class TimedSync(Sync):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.execute_time = 0.0
+
+    def _execute_targets(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            super()._execute_targets(*args, **kwargs)
+        finally:
+            self.execute_time += time.perf_counter() - start
+
+def write_file(path: str, size: int, rng: random.Random):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1024 * 1024)
+            f.write(rng.randbytes(chunk))
+            remaining -= chunk
+
+def build_tiny(root: str, scale: float, rng: random.Random) -> list[SyncItem]:
+    source = os.path.join(root, 'src')
+    for i in range(int(20000 * scale)):
+        write_file(os.path.join(source, f'd{i % 200}', f'f{i}.txt'), rng.randint(0, 2048), rng)
+    return [SyncItem('tiny', source, os.path.join(root, 'dst'))]
+
+def build_huge(root: str, scale: float, rng: random.Random) -> list[SyncItem]:
+    source = os.path.join(root, 'src')
+    for i in range(4):
+        write_file(os.path.join(source, f'big{i}.bin'), int(128 * 1024 * 1024 * scale), rng)
+    return [SyncItem('huge', source, os.path.join(root, 'dst'))]
+
+def build_deep(root: str, scale: float, rng: random.Random) -> list[SyncItem]:
+    source = os.path.join(root, 'src')
+    for branch in range(max(1, int(20 * scale))):
+        path = os.path.join(source, f'b{branch}')
+        for depth in range(60):
+            path = os.path.join(path, f'l{depth}')
+            write_file(os.path.join(path, 'f.txt'), rng.randint(0, 4096), rng)
+    return [SyncItem('deep', source, os.path.join(root, 'dst'))]
+
+def build_mixed(root: str, scale: float, rng: random.Random) -> list[SyncItem]:
+    source = os.path.join(root, 'src')
+    for i in range(int(10000 * scale)):
+        write_file(os.path.join(source, f'd{i % 100}', f'f{i}.bin'), rng.randint(0, 64 * 1024), rng)
+    return [SyncItem('mixed', source, os.path.join(root, 'dst'))]
+
+def build_filelist(root: str, scale: float, rng: random.Random) -> list[SyncItem]:
+    paths = []
+    for i in range(int(5000 * scale)):
+        path = os.path.join(root, 'src', f'd{i % 100}', f'f{i}.bin')
+        write_file(path, rng.randint(0, 16 * 1024), rng)
+        paths.append(path)
+    return [SyncItem('filelist', paths, os.path.join(root, 'dst'))]
+
+def build_fanout(root: str, scale: float, rng: random.Random) -> list[SyncItem]:
+    # One source mirrored to three destinations; the items are grouped and share one scan
+    source = os.path.join(root, 'src')
+    for i in range(int(5000 * scale)):
+        write_file(os.path.join(source, f'd{i % 100}', f'f{i}.bin'), rng.randint(0, 64 * 1024), rng)
+    for i in range(2):
+        write_file(os.path.join(source, f'big{i}.bin'), int(64 * 1024 * 1024 * scale), rng)
+    return [SyncItem(f'fanout{i}', source, os.path.join(root, f'dst{i}')) for i in range(3)]
+
+def sources(items: list[SyncItem]) -> list[SyncItem]:
+    # Fan-out scenarios have several items per source; mutate and measure each source once
+    return list({repr(item.source): item for item in items}.values())
+
+def update_file(path: str, rng: random.Random):
+    # Large files get one block rewritten in place, the way big files usually change, so delta
+    # copies have something to find; small files are replaced
+    size = os.path.getsize(path)
+    if size > 1024 * 1024:
+        with open(path, 'r+b') as f:
+            f.seek(rng.randrange(size - 64 * 1024))
+            f.write(rng.randbytes(64 * 1024))
+    else:
+        write_file(path, rng.randint(1, 64 * 1024), rng)
+    os.utime(path, (time.time() + 120, time.time() + 120))
+
+def mutate(items: list[SyncItem], rng: random.Random) -> dict:
+    # Touch ~10% of files, delete ~10%, add as many new ones; every tree gets at least one update
+    counts = {'updated': 0, 'deleted': 0, 'added': 0}
+    for item in sources(items):
+        if isinstance(item.source, list):
+            for path in rng.sample(item.source, max(1, len(item.source) // 10)):
+                update_file(path, rng)
+                counts['updated'] += 1
+            continue
+        files = sorted(os.path.join(directory, name) for directory, _, names in os.walk(item.source) for name in names)
+        for index, path in enumerate(rng.sample(files, max(1, len(files) // 5))):
+            if index > 0 and rng.random() < 0.5:
+                os.remove(path)
+                counts['deleted'] += 1
+            else:
+                update_file(path, rng)
+                counts['updated'] += 1
+        for i in range(len(files) // 10):
+            write_file(os.path.join(item.source, 'new', f'n{i}.bin'), rng.randint(0, 64 * 1024), rng)
+            counts['added'] += 1
+    return counts
+
+def tree_size(items: list[SyncItem]) -> tuple[int, int]:
+    files = 0
+    size = 0
+    for item in sources(items):
+        paths = item.source if isinstance(item.source, list) else (os.path.join(d, n) for d, _, names in os.walk(item.source) for n in names)
+        for path in paths:
+            files += 1
+            size += os.path.getsize(path)
+    return files, size
+
+def run_phase(name: str, items: list[SyncItem], workers: int) -> dict:
+    sync = TimedSync(workers=workers)
+    copied = 0
+    start = time.perf_counter()
+    plans = sync.sync_items(items)
+    wall = time.perf_counter() - start
+    for plan in plans:
+        copied += plan.total_bytes
+    files, size = tree_size(items)
+    return {
+        'phase': name,
+        'wall_s': round(wall, 4),
+        'scan_s': round(wall - sync.execute_time, 4),
+        'execute_s': round(sync.execute_time, 4),
+        'files': files,
+        'bytes_copied': copied,
+        'files_per_s': round(files / wall, 1) if wall else None,
+        'mb_per_s': round(copied / 1048576 / wall, 2) if wall else None,
+        'source_bytes': size,
+    }
+
+def run_scenario(scenario: str, scale: float, workers: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    root = tempfile.mkdtemp(prefix=f'sync-bench-{scenario}-')
+    cwd = os.getcwd()
+    try:
+        # Manifests are kept next to the working directory, so keep them inside the sandbox
+        os.chdir(root)
+        items = globals()[f'build_{scenario}'](root, scale, rng)
+        for item in items:
+            os.makedirs(item.destination, exist_ok=True)
+        phases = [run_phase('cold', items, workers), run_phase('warm', items, workers)]
+        changes = mutate(items, rng)
+        phase = run_phase('mutated', items, workers)
+        phase['changes'] = changes
+        phases.append(phase)
+        return {
+            'scenario': scenario,
+            'phases': phases,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+def compare(path: str, results: list[dict]):
+    with open(path, 'r', encoding='utf-8') as f:
+        baseline = {(result['scenario'], phase['phase']): phase for result in json.load(f)['results'] for phase in result['phases']}
+    for result in results:
+        for phase in result['phases']:
+            old = baseline.get((result['scenario'], phase['phase']))
+            if old is None or not old['wall_s']:
+                continue
+            change = (phase['wall_s'] - old['wall_s']) / old['wall_s'] * 100
+            print(f"{result['scenario']:9} {phase['phase']:8} {old['wall_s']:8.3f}s -> {phase['wall_s']:8.3f}s ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Sync engine on synthetic trees")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="scenario to run (default: all)")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplier for file counts and sizes")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="earlier results JSON to compare wall times against")
+    parser.add_argument('--inline', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.inline:
+        # Child process: one scenario, so peak RSS belongs to that scenario alone
+        print(json.dumps(run_scenario(args.scenario[0], args.scale, args.workers, args.seed)))
+        return
+
+    results = []
+    for scenario in args.scenario or SCENARIOS:
+        command = [sys.executable, os.path.abspath(__file__), '--inline', '--scenario', scenario,
+                   '--scale', str(args.scale), '--workers', str(args.workers), '--seed', str(args.seed)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        for phase in result['phases']:
+            print(f"{scenario:9} {phase['phase']:8} {phase['wall_s']:8.3f}s  scan {phase['scan_s']:7.3f}s  "
+                  f"exec {phase['execute_s']:7.3f}s  {phase['files_per_s'] or 0:10.1f} files/s  "
+                  f"{phase['mb_per_s'] or 0:8.2f} MB/s")
+        print(f"{scenario:9} peak RSS {result['peak_rss_kb'] / 1024:.1f} MB")
+
+    if args.compare:
+        compare(args.compare, results)
+
+    if args.output:
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': args.scale,
+            'workers': args.workers,
+            'seed': args.seed,
+            'results': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
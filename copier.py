@@ -0,0 +1,366 @@
+from typing import Callable, Optional
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import os
+import queue
+import stat
+import sys
+import threading
+from throttle import Throttle
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+DELTA_BLOCK_SIZE = 1024 * 1024
+FICLONE = 0x40049409
+PARTIAL_SUFFIX = '.sync-part'
+NAME_MAX = 255
+# Leading dot, separator and the widest size-mtime tag (two 64-bit hex numbers and a dash)
+PARTIAL_RESERVE = 2 + 33 + len(PARTIAL_SUFFIX)
+RESUME_THRESHOLD = 64 * 1024 * 1024
+RESUME_SEGMENT = 64 * 1024 * 1024
+RESUME_BLOCK = 1024 * 1024
+THROTTLE_SEGMENT = 1024 * 1024
+FANOUT_QUEUE = 4
+FANOUT_THREADED_SIZE = 1024 * 1024
+
+_FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM, errno.ETXTBSY}
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class CopyCancelled(Exception):
+    pass
+
+def _load_syncfs():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        syncfs = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+    syncfs.argtypes = [ctypes.c_int]
+    return syncfs
+
+_syncfs = _load_syncfs()
+
+def partial_path(dest_file: str, source_stat: os.stat_result) -> str:
+    # The name carries the source size and mtime, so a partial of another version is never resumed
+    directory, name = os.path.split(dest_file)
+    return os.path.join(directory, f".{partial_stem(name)}.{source_stat.st_size:x}-{source_stat.st_mtime_ns:x}{PARTIAL_SUFFIX}")
+
+def partial_stem(name: str) -> str:
+    # Names too long to take the tag are cut and given a hash of the full name, so the
+    # partial still fits in NAME_MAX and maps back to one destination file
+    encoded = os.fsencode(name)
+    if len(encoded) + PARTIAL_RESERVE <= NAME_MAX:
+        return name
+    digest = hashlib.blake2b(encoded, digest_size=8).hexdigest()
+    keep = NAME_MAX - PARTIAL_RESERVE - len(digest) - 1
+    return encoded[:keep].decode('utf-8', 'ignore') + '~' + digest
+
+def partial_target(name: str) -> Optional[str]:
+    # The partial_stem of the destination file a partial belongs to
+    if not name.startswith('.') or not name.endswith(PARTIAL_SUFFIX):
+        return None
+    target, sep, _ = name[1:-len(PARTIAL_SUFFIX)].rpartition('.')
+    return target if sep else None
+
+def copy_file(source_file: str, dest_file: str, source_stat: os.stat_result, buffer_size: int = COPY_BUFFER_SIZE, cancelled: Optional[Callable[[], bool]] = None, throttle: Optional[Throttle] = None) -> str:
+    # Data goes to a partial file next to dest_file, which is replaced only once the copy is complete.
+    # Large files check the throttle before every segment, so a cap set mid-copy still applies.
+    partial = partial_path(dest_file, source_stat)
+    resumable = source_stat.st_size >= RESUME_THRESHOLD
+    try:
+        if resumable or (throttle is not None and throttle.limits_bandwidth):
+            strategy = _segmented_copy(source_file, partial, source_stat.st_size, buffer_size, cancelled, throttle, resumable)
+        else:
+            with open(source_file, 'rb') as fsrc, open(partial, 'wb') as fdst:
+                strategy = copy_data(fsrc.fileno(), fdst.fileno(), source_stat.st_size, buffer_size)
+    except BaseException:
+        if not resumable:
+            _discard(partial)
+        raise
+    copy_metadata(partial, source_stat)
+    os.replace(partial, dest_file)
+    return strategy
+
+def copy_fanout(source_file: str, dest_files: list[str], source_stat: os.stat_result, buffer_size: int = COPY_BUFFER_SIZE, cancelled: Optional[Callable[[], bool]] = None, throttle: Optional[Throttle] = None) -> list[Optional[OSError]]:
+    # Reads source_file once and hands every chunk to all destinations; returns one error
+    # (or None) per destination, so a failing disk doesn't fail the copies to the others
+    size = source_stat.st_size
+    writers = []
+    errors = [None] * len(dest_files)
+    with open(source_file, 'rb') as fsrc:
+        src_fd = fsrc.fileno()
+        try:
+            for index, dest_file in enumerate(dest_files):
+                try:
+                    writers.append(_FanoutWriter(partial_path(dest_file, source_stat), src_fd, size, size >= FANOUT_THREADED_SIZE))
+                except OSError as e:
+                    errors[index] = e
+                    writers.append(None)
+            active = [writer for writer in writers if writer is not None]
+            # Start where the least complete destination left off; the others skip what they have
+            offset = min((writer.offset for writer in active), default=size)
+            while offset < size:
+                if cancelled is not None and cancelled():
+                    raise CopyCancelled(source_file)
+                count = min(buffer_size, size - offset)
+                if throttle is not None and throttle.limits_bandwidth:
+                    count = min(count, THROTTLE_SEGMENT)
+                    throttle.consume_bytes(count)
+                data = _read_at(src_fd, count, offset)
+                if not data:
+                    break
+                for writer in active:
+                    writer.put(offset, data)
+                offset += len(data)
+        except BaseException:
+            for writer in writers:
+                if writer is not None:
+                    writer.close()
+                    if size < RESUME_THRESHOLD:
+                        _discard(writer.partial)
+            raise
+        for writer in writers:
+            if writer is not None:
+                writer.close()
+
+    for index, (dest_file, writer) in enumerate(zip(dest_files, writers)):
+        if writer is None:
+            continue
+        try:
+            if writer.error is not None:
+                raise writer.error
+            copy_metadata(writer.partial, source_stat)
+            os.replace(writer.partial, dest_file)
+        except OSError as e:
+            errors[index] = e
+            if size < RESUME_THRESHOLD:
+                _discard(writer.partial)
+    return errors
+
+class _FanoutWriter:
+    # Writes one destination of a fan-out copy. Larger files get a thread and a short queue,
+    # so destinations on different disks are written concurrently.
+    def __init__(self, partial: str, src_fd: int, size: int, threaded: bool):
+        self.partial = partial
+        self.error = None
+        self.fd = os.open(partial, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            self.offset = _resume_offset(src_fd, self.fd, size) if size >= RESUME_THRESHOLD else 0
+            os.ftruncate(self.fd, self.offset)
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.queue = None
+        self.thread = None
+        if threaded:
+            self.queue = queue.Queue(FANOUT_QUEUE)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def put(self, offset: int, data: bytes):
+        if self.error is not None or offset + len(data) <= self.offset:
+            return
+        if self.queue is None:
+            self._write(offset, data)
+        else:
+            self.queue.put((offset, data))
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        os.close(self.fd)
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is None:
+                self._write(*chunk)
+
+    def _write(self, offset: int, data: bytes):
+        view = memoryview(data)[max(self.offset - offset, 0):]
+        try:
+            while view:
+                view = view[os.write(self.fd, view):]
+        except OSError as e:
+            self.error = e
+            return
+        self.offset = offset + len(data)
+
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _segmented_copy(source_file: str, partial: str, size: int, buffer_size: int, cancelled: Optional[Callable[[], bool]], throttle: Optional[Throttle] = None, resume: bool = True) -> str:
+    # Large files are copied in segments; whatever an interrupted run left in the partial
+    # file is kept and the copy continues from there. Segments are short while a cap is set.
+    with open(source_file, 'rb') as fsrc:
+        src_fd = fsrc.fileno()
+        dst_fd = os.open(partial, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            offset = _resume_offset(src_fd, dst_fd, size) if resume else 0
+            os.ftruncate(dst_fd, offset)
+            if offset == 0 and size > 0 and _reflink(src_fd, dst_fd):
+                return 'reflink'
+            strategy = 'resumed' if offset > 0 else None
+            while offset < size:
+                if cancelled is not None and cancelled():
+                    raise CopyCancelled(partial)
+                count = min(RESUME_SEGMENT, size - offset)
+                if throttle is not None and throttle.limits_bandwidth:
+                    count = min(count, THROTTLE_SEGMENT)
+                    throttle.consume_bytes(count)
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                used, copied = _copy_range(src_fd, dst_fd, count, buffer_size)
+                if copied == 0:
+                    break
+                strategy = strategy or used
+                offset += copied
+            return strategy or 'buffered'
+        finally:
+            os.close(dst_fd)
+
+def _resume_offset(src_fd: int, dst_fd: int, size: int) -> int:
+    # Keep the partial only as far as it matches the source: writes are not flushed per file, so
+    # after a crash zeroed or stale blocks can sit anywhere in it, not only at the end
+    end = min(os.fstat(dst_fd).st_size, size) // RESUME_BLOCK * RESUME_BLOCK
+    offset = 0
+    while offset < end and _read_at(src_fd, RESUME_BLOCK, offset) == _read_at(dst_fd, RESUME_BLOCK, offset):
+        offset += RESUME_BLOCK
+    return offset
+
+def _read_at(fd: int, count: int, offset: int) -> bytes:
+    if hasattr(os, 'pread'):
+        return os.pread(fd, count, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, count)
+
+def _copy_range(src_fd: int, dst_fd: int, count: int, buffer_size: int) -> tuple[str, int]:
+    # Copies up to count bytes from the current positions of both descriptors
+    copied = _copy_file_range(src_fd, dst_fd, count, limit=count)
+    if copied:
+        return 'copy_file_range', copied
+    copied = _sendfile(src_fd, dst_fd, count, limit=count)
+    if copied:
+        return 'sendfile', copied
+    return 'buffered', _buffered_copy(src_fd, dst_fd, min(buffer_size, max(count, 1)), limit=count)
+
+def sync_filesystem(path: str):
+    # One syncfs for everything an item wrote, instead of an fsync per file
+    if _syncfs is not None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if _syncfs(fd) != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error), path)
+        finally:
+            os.close(fd)
+    elif hasattr(os, 'sync'):
+        os.sync()
+
+def delta_copy(source_file: str, dest_file: str, source_stat: os.stat_result, block_size: int = DELTA_BLOCK_SIZE, throttle: Optional[Throttle] = None) -> int:
+    # Both files are local, so blocks are compared directly instead of exchanging checksums
+    written = 0
+    offset = 0
+    with open(source_file, 'rb') as fsrc, open(dest_file, 'r+b') as fdst:
+        while True:
+            if throttle is not None and throttle.limits_bandwidth:
+                throttle.consume_bytes(block_size)
+            source_block = fsrc.read(block_size)
+            if not source_block:
+                break
+            dest_block = fdst.read(len(source_block))
+            if source_block != dest_block:
+                fdst.seek(offset)
+                fdst.write(source_block)
+                written += len(source_block)
+            offset += len(source_block)
+        fdst.truncate(offset)
+    copy_metadata(dest_file, source_stat)
+    return written
+
+def copy_metadata(dest_file: str, source_stat: os.stat_result):
+    os.chmod(dest_file, stat.S_IMODE(source_stat.st_mode))
+    os.utime(dest_file, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+def copy_data(src_fd: int, dst_fd: int, size: int, buffer_size: int = COPY_BUFFER_SIZE) -> str:
+    if size > 0:
+        if _reflink(src_fd, dst_fd):
+            return 'reflink'
+        if _copy_file_range(src_fd, dst_fd, size):
+            return 'copy_file_range'
+        if _sendfile(src_fd, dst_fd, size):
+            return 'sendfile'
+    # Sized to the file: zero-filling a full buffer per small file dominates when this path is the only one
+    _buffered_copy(src_fd, dst_fd, min(buffer_size, max(size, 1)))
+    return 'buffered'
+
+def _reflink(src_fd: int, dst_fd: int) -> bool:
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+def _copy_file_range(src_fd: int, dst_fd: int, size: int, limit: Optional[int] = None) -> int:
+    if not hasattr(os, 'copy_file_range'):
+        return 0
+    return _kernel_copy(lambda count: os.copy_file_range(src_fd, dst_fd, count), src_fd, dst_fd, size, limit)
+
+def _sendfile(src_fd: int, dst_fd: int, size: int, limit: Optional[int] = None) -> int:
+    if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+        return 0
+    return _kernel_copy(lambda count: os.sendfile(dst_fd, src_fd, None, count), src_fd, dst_fd, size, limit)
+
+def _kernel_copy(copy_chunk, src_fd: int, dst_fd: int, size: int, limit: Optional[int] = None) -> int:
+    # Without a limit, copies to EOF; returns the byte count, 0 meaning "use another strategy"
+    copied = 0
+    try:
+        while limit is None or copied < limit:
+            sent = copy_chunk(max(size - copied, 1 << 30) if limit is None else limit - copied)
+            if sent == 0:
+                break
+            copied += sent
+    except OSError as e:
+        if copied == 0 and e.errno in _FALLBACK_ERRORS:
+            return 0
+        raise
+    if copied == 0 and limit is None:
+        # Some filesystems (procfs-like or FUSE) report 0 bytes instead of failing
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dst_fd, 0, os.SEEK_SET)
+    return copied
+
+def _buffered_copy(src_fd: int, dst_fd: int, buffer_size: int, limit: Optional[int] = None) -> int:
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    total = 0
+    while limit is None or total < limit:
+        chunk = view if limit is None else view[:min(buffer_size, limit - total)]
+        read = os.readv(src_fd, [chunk]) if hasattr(os, 'readv') else _readinto(src_fd, chunk)
+        if read == 0:
+            break
+        written = 0
+        while written < read:
+            written += os.write(dst_fd, view[written:read])
+        total += read
+    return total
+
+def _readinto(fd: int, view: memoryview) -> int:
+    data = os.read(fd, len(view))
+    view[:len(data)] = data
+    return len(data)
@@ -0,0 +1,41 @@
+from typing import Optional
+import threading
+
+class SyncEvents:
+    # Hand-off from the sync worker to the UI thread. New log lines queue up in order;
+    # status-line rewrites and progress keep only their latest value, so a slow UI
+    # merges them instead of falling further behind.
+    def __init__(self):
+        self.lines = []
+        self.status = {}
+        self.latest_progress = None
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+
+    def log(self, text: str, new_line: bool, key: Optional[str] = None):
+        with self._lock:
+            if new_line:
+                # A pending rewrite belongs to the line before this one, so keep it in order
+                if key in self.status:
+                    self.lines.append((self.status.pop(key), False, key))
+                self.lines.append((text, True, key))
+            else:
+                self.status[key] = text
+
+    def progress(self, current: str, total: str):
+        with self._lock:
+            self.latest_progress = (current, total)
+
+    def finish(self):
+        self.finished.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self.finished.wait(timeout)
+
+    def drain(self) -> tuple[list[tuple[str, bool, Optional[str]]], dict[Optional[str], str], Optional[tuple[str, str]]]:
+        with self._lock:
+            lines, status, progress = self.lines, self.status, self.latest_progress
+            self.lines = []
+            self.status = {}
+            self.latest_progress = None
+        return lines, status, progress
@@ -0,0 +1,108 @@
+from typing import Optional
+import os
+import re
+
+DEFAULT_EXCLUDE = ['.git/', '.stfolder/']
+
+_GLOB_CHARS = set('*?[\\')
+
+def _translate(pattern: str) -> str:
+    # gitignore-style glob -> regex body: '*' and '?' stay inside one path component, '**' crosses them
+    result = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            result.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            result.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            result.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars[0] in '!^':
+                chars = '^' + chars[1:]
+            result.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            result.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            result.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(result)
+
+class _PatternSet:
+    # Plain names ('node_modules', '.git/') become set lookups over the path components;
+    # everything else is joined into one regex per kind, compiled once
+    def __init__(self, patterns: list[str], files_below_dirs: bool = False):
+        self.names = set()
+        self.dir_names = set()
+        file_parts = []
+        dir_parts = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            pattern = pattern.lstrip('/')
+            if not anchored and not _GLOB_CHARS & set(pattern):
+                (self.dir_names if dir_only else self.names).add(pattern)
+                continue
+            body = ('' if anchored else '(?:.*/)?') + _translate(pattern)
+            dir_parts.append(body)
+            file_parts.append(body + ('/.*' if dir_only else '(?:/.*)?'))
+        if files_below_dirs:
+            # Include rules: a matched directory brings in every file below it
+            file_parts = [part + '(?:/.*)?' for part in dir_parts]
+        self.file_regex = re.compile('(?:' + '|'.join(file_parts) + r')\Z') if file_parts else None
+        self.dir_regex = re.compile('(?:' + '|'.join(dir_parts) + r')\Z') if dir_parts else None
+        self.empty = not (self.names or self.dir_names or file_parts)
+
+    def matches_file(self, rel: str, parts: list[str]) -> bool:
+        if self.names and not self.names.isdisjoint(parts):
+            return True
+        if self.dir_names and not self.dir_names.isdisjoint(parts[:-1]):
+            return True
+        return self.file_regex is not None and self.file_regex.match(rel) is not None
+
+    def matches_dir(self, rel: str, parts: list[str]) -> bool:
+        if (self.names or self.dir_names) and not (self.names.isdisjoint(parts) and self.dir_names.isdisjoint(parts)):
+            return True
+        return self.dir_regex is not None and self.dir_regex.match(rel) is not None
+
+class PathFilter:
+    # Paths are relative to the item root. Excluded directories are never descended into,
+    # and '!pattern' re-includes what the other exclude patterns matched. With include
+    # patterns, only files matching one of them are synced.
+    def __init__(self, exclude: Optional[list[str]] = None, include: Optional[list[str]] = None):
+        exclude = list(exclude or [])
+        self._exclude = _PatternSet([pattern for pattern in exclude if not pattern.startswith('!')])
+        self._reinclude = _PatternSet([pattern[1:] for pattern in exclude if pattern.startswith('!')])
+        self._include = _PatternSet(list(include or []), files_below_dirs=True)
+
+    def dir_excluded(self, rel: str) -> bool:
+        rel = self._normalize(rel)
+        parts = rel.split('/')
+        return self._exclude.matches_dir(rel, parts) and not self._reinclude.matches_dir(rel, parts)
+
+    def file_excluded(self, rel: str) -> bool:
+        rel = self._normalize(rel)
+        parts = rel.split('/')
+        if self._exclude.matches_file(rel, parts) and not self._reinclude.matches_file(rel, parts):
+            return True
+        return not self._include.empty and not self._include.matches_file(rel, parts)
+
+    def _normalize(self, rel: str) -> str:
+        return rel.replace(os.sep, '/') if os.sep != '/' else rel
+
+def compile_filter(exclude: Optional[list[str]] = None, include: Optional[list[str]] = None) -> PathFilter:
+    return PathFilter(DEFAULT_EXCLUDE + list(exclude or []), include)
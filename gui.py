@@ -1,12 +1,25 @@
 import flet as ft
 import sys
 import os
+import threading
 from sync import Sync, SyncItem
+from logbuffer import LogBuffer, LOG_FILE, LOG_LINES
+from events import SyncEvents
+from throttle import parse_rate
+
+FRAME_INTERVAL = 0.1
 
 class App:
-    def __init__(self, groups):
+    def __init__(self, groups, log_lines: int = LOG_LINES, log_file: str = LOG_FILE, sync: Sync = None):
         self.page = None
         self.groups = groups
+        self.groups_by_id = {id(group): group for group in groups}
+        self.group_positions = {id(group): position for position, group in enumerate(groups)}
+        self.group_rows = {}
+        self.group_checkboxes = {}
+        self.group_icons = {}
+        self.group_items = {}
+        self.item_checkboxes = {}
         self.expanded_groups = set()
         self.list_view = None
         self.selected_items = set()
@@ -14,62 +27,90 @@ class App:
         self.sync_button = None
         self.edit_button = None
         self.back_button = None
-        self.sync = Sync()
+        self.sync = sync
+        if self.sync is None:
+            self.sync = Sync()
+            self.sync.protect_destinations([item for group in groups for item in group.items])
         self.progress_bar = None
         self.log_view = None
-        self.logs = []
+        self.log_lines = log_lines
+        self.log_file = log_file
+        self.logs = LogBuffer(log_lines, None)
+        self.cancel_button = None
+        self.bandwidth_field = None
 
     def build_group_items(self):
         items = []
         for group in self.groups:
-            group_id = id(group)
-            items.append(
-                ft.Container(
+            items.append(self.group_row(group))
+            if id(group) in self.expanded_groups:
+                items.extend(self.item_rows(group))
+        return items
+
+    def group_row(self, group):
+        group_id = id(group)
+        if group_id not in self.group_rows:
+            self.group_checkboxes[group_id] = ft.Checkbox(
+                value=group_id in self.selected_groups,
+                on_change=lambda e, g=group_id: self.on_group_checkbox_change(g, e.control.value)
+            )
+            self.group_icons[group_id] = ft.Icon(
+                ft.Icons.EXPAND_MORE if group_id in self.expanded_groups else ft.Icons.CHEVRON_RIGHT,
+                color=ft.Colors.WHITE,
+                size=20
+            )
+            self.group_rows[group_id] = ft.Container(
+                ft.Row([
                     ft.Row([
-                        ft.Row([
-                            ft.Checkbox(
-                                value=group_id in self.selected_groups,
-                                on_change=lambda e, g=group_id: self.on_group_checkbox_change(g, e.control.value)
-                            ),
-                            ft.Text(group.name, size=16, color=ft.Colors.WHITE),
-                        ], spacing=10),
-                        ft.Icon(
-                            ft.Icons.EXPAND_MORE if group_id in self.expanded_groups else ft.Icons.CHEVRON_RIGHT,
-                            color=ft.Colors.WHITE,
-                            size=20
-                        ),
-                    ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
-                    padding=10,
-                    border_radius=8,
-                    bgcolor={"hovered": ft.Colors.BLACK87},
-                    ink=True,
-                    on_click=lambda e, g=group_id: self.on_group_click(g),
-                )
+                        self.group_checkboxes[group_id],
+                        ft.Text(group.name, size=16, color=ft.Colors.WHITE),
+                    ], spacing=10),
+                    self.group_icons[group_id],
+                ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+                padding=10,
+                border_radius=8,
+                bgcolor={"hovered": ft.Colors.BLACK87},
+                ink=True,
+                on_click=lambda e, g=group_id: self.on_group_click(g),
             )
-            if group_id in self.expanded_groups:
-                items.append(
+        return self.group_rows[group_id]
+
+    def item_rows(self, group):
+        # Item rows are built the first time their group is expanded and kept afterwards.
+        # They sit directly in the ListView so only the visible ones are rendered.
+        group_id = id(group)
+        if group_id not in self.group_items:
+            rows = []
+            for item in group.items:
+                item_id = id(item)
+                self.item_checkboxes[item_id] = ft.Checkbox(
+                    value=item_id in self.selected_items,
+                    on_change=lambda e, i=item_id: self.on_item_checkbox_change(i, e.control.value)
+                )
+                rows.append(
                     ft.Container(
-                        ft.Column([
+                        ft.Row([
+                            self.item_checkboxes[item_id],
                             ft.Column([
-                                ft.Row([
-                                    ft.Checkbox(
-                                        value=id(item) in self.selected_items,
-                                        on_change=lambda e, i=id(item): self.on_item_checkbox_change(i, e.control.value)
-                                    ),
-                                    ft.Column([
-                                        ft.Text(item.name, size=12, weight=ft.FontWeight.BOLD, color=ft.Colors.WHITE),
-                                        ft.Text(self.format_source(item.source), size=12, color=ft.Colors.WHITE70),
-                                        ft.Text(f"To: {item.destination}", size=12, color=ft.Colors.WHITE70),
-                                    ], spacing=2)
-                                ], spacing=10)
-                            ], spacing=8)
-                            for item in group.items
-                        ], spacing=8),
-                        padding=ft.padding.only(left=20, top=5, bottom=5),
+                                ft.Text(item.name, size=12, weight=ft.FontWeight.BOLD, color=ft.Colors.WHITE),
+                                ft.Text(self.format_source(item.source), size=12, color=ft.Colors.WHITE70),
+                                ft.Text(self.format_destination(item.destination), size=12, color=ft.Colors.WHITE70),
+                            ], spacing=2)
+                        ], spacing=10),
+                        padding=ft.padding.only(left=20, top=4, bottom=4),
                         bgcolor=ft.Colors.BLACK45
                     )
                 )
-        return items
+            self.group_items[group_id] = rows
+        return self.group_items[group_id]
+
+    def row_position(self, group_id):
+        position = 0
+        for group in self.groups[:self.group_positions[group_id]]:
+            position += 1
+            if id(group) in self.expanded_groups:
+                position += len(group.items)
+        return position
 
     def update_sync_button_visibility(self):
         if self.sync_button and self.edit_button:
@@ -79,33 +120,33 @@ class App:
             else:
                 self.sync_button.visible = False
                 self.edit_button.visible = True
-            self.page.update()
 
     def on_group_checkbox_change(self, group_id, value):
+        group = self.groups_by_id[group_id]
+        changed = []
         if value:
             self.selected_groups.add(group_id)
-            for group in self.groups:
-                if id(group) == group_id:
-                    for item in group.items:
-                        self.selected_items.add(id(item))
+            for item in group.items:
+                self.selected_items.add(id(item))
         else:
-            self.selected_groups.remove(group_id)
-            for group in self.groups:
-                if id(group) == group_id:
-                    for item in group.items:
-                        self.selected_items.discard(id(item))
-        self.list_view.controls = self.build_group_items()
+            self.selected_groups.discard(group_id)
+            for item in group.items:
+                self.selected_items.discard(id(item))
+        for item in group.items:
+            checkbox = self.item_checkboxes.get(id(item))
+            if checkbox is not None and checkbox.value != value:
+                checkbox.value = value
+                changed.append(checkbox)
         self.update_sync_button_visibility()
-        self.list_view.update()
+        self.page.update(self.sync_button, self.edit_button, *changed)
 
     def on_item_checkbox_change(self, item_id, value):
         if value:
             self.selected_items.add(item_id)
         else:
             self.selected_items.discard(item_id)
-        self.list_view.controls = self.build_group_items()
         self.update_sync_button_visibility()
-        self.list_view.update()
+        self.page.update(self.sync_button, self.edit_button)
 
     def format_source(self, source):
         if isinstance(source, list):
@@ -119,38 +160,24 @@ class App:
         else:
             return f"From: {source}"
 
+    def format_destination(self, destination):
+        if isinstance(destination, list):
+            return f"To: {', '.join(destination)}"
+        return f"To: {destination}"
+
     def on_group_click(self, group_id):
+        group = self.groups_by_id[group_id]
+        position = self.row_position(group_id) + 1
         if group_id in self.expanded_groups:
             self.expanded_groups.remove(group_id)
+            del self.list_view.controls[position:position + len(group.items)]
+            self.group_icons[group_id].name = ft.Icons.CHEVRON_RIGHT
         else:
             self.expanded_groups.add(group_id)
-        self.list_view.controls = self.build_group_items()
+            self.list_view.controls[position:position] = self.item_rows(group)
+            self.group_icons[group_id].name = ft.Icons.EXPAND_MORE
         self.list_view.update()
 
-    def on_progress(self, current: str, total: str):
-        if self.progress_bar and current and total:
-            try:
-                current_num = float(current)
-                total_num = float(total)
-                if total_num > 0:
-                    self.progress_bar.value = current_num / total_num
-                    self.page.update()
-            except (ValueError, TypeError):
-                pass
-
-    def on_log(self, log: str, new_line: bool):
-        if new_line:
-            self.logs.append(log)
-        else:
-            if self.logs:
-                self.logs[-1] = log
-            else:
-                self.logs.append(log)
-        if self.log_view:
-            self.log_view.value = "\n".join(self.logs)
-            self.log_view.cursor_position = len(self.log_view.value)
-            self.page.update()
-
     def on_sync_click(self, e):
         selected_items = []
         for group in self.groups:
@@ -161,17 +188,80 @@ class App:
         if selected_items:
             self.sync_button.visible = False
             self.progress_bar.visible = True
+            self.progress_bar.value = 0
             self.list_view.visible = False
             self.log_view.visible = True
-            self.logs = []
+            self.logs = LogBuffer(self.log_lines, self.log_file)
             self.back_button.visible = False
+            self.cancel_button.visible = True
+            self.cancel_button.disabled = False
+            self.bandwidth_field.visible = True
             self.page.update()
-            
-            self.sync.sync_items(selected_items, self.on_progress, self.on_log)
-            
-            self.progress_bar.visible = False
-            self.back_button.visible = True
+
+            events = SyncEvents()
+            threading.Thread(target=self.run_sync, args=(selected_items, events), daemon=True).start()
+            threading.Thread(target=self.pump_events, args=(events,), daemon=True).start()
+
+    def run_sync(self, items, events: SyncEvents):
+        try:
+            self.sync.sync_items(items, events.progress, events.log)
+        finally:
+            events.finish()
+
+    def pump_events(self, events: SyncEvents):
+        # Apply whatever the worker produced at most once per frame, then render once
+        while True:
+            finished = events.wait(FRAME_INTERVAL)
+            self.apply_events(events)
+            if finished:
+                break
+        self.logs.close()
+        self.progress_bar.visible = False
+        self.cancel_button.visible = False
+        self.bandwidth_field.visible = False
+        self.back_button.visible = True
+        self.page.update()
+
+    def apply_events(self, events: SyncEvents):
+        lines, status, progress = events.drain()
+        if not lines and not status and progress is None:
+            return
+        for log, new_line, key in lines:
+            if new_line:
+                self.logs.append(log, key)
+            else:
+                self.logs.replace(log, key)
+        for key, log in status.items():
+            self.logs.replace(log, key)
+        if lines or status:
+            self.log_view.value = self.logs.text()
+            self.log_view.cursor_position = len(self.log_view.value)
+        if progress is not None:
+            try:
+                current_num = float(progress[0])
+                total_num = float(progress[1])
+                if total_num > 0:
+                    self.progress_bar.value = current_num / total_num
+            except (ValueError, TypeError):
+                pass
+        self.page.update()
+
+    def on_cancel_click(self, e):
+        self.sync.cancel()
+        self.cancel_button.disabled = True
+        self.page.update()
+
+    def on_bandwidth_submit(self, e):
+        # Changes the cap of the running sync; an empty field or 0 lifts it
+        try:
+            rate = parse_rate(self.bandwidth_field.value)
+        except ValueError:
+            self.bandwidth_field.error_text = "Например: 20M"
             self.page.update()
+            return
+        self.bandwidth_field.error_text = None
+        self.sync.set_bandwidth(rate)
+        self.page.update()
 
     def show_groups(self, e=None):
         self.list_view.visible = True
@@ -248,6 +338,30 @@ class App:
             visible=False
         )
 
+        self.cancel_button = ft.IconButton(
+            icon=ft.Icons.STOP,
+            icon_color=ft.Colors.WHITE,
+            icon_size=20,
+            style=ft.ButtonStyle(
+                color=ft.Colors.WHITE,
+                bgcolor=ft.Colors.ORANGE,
+                shape=ft.CircleBorder(),
+            ),
+            on_click=self.on_cancel_click,
+            visible=False
+        )
+
+        rate = self.sync.throttle.bandwidth.rate
+        self.bandwidth_field = ft.TextField(
+            value=f"{rate / 1024 ** 2:g}M" if rate else "",
+            label="Лимит, байт/с",
+            hint_text="20M",
+            width=140,
+            dense=True,
+            on_submit=self.on_bandwidth_submit,
+            visible=False
+        )
+
         self.edit_button = ft.IconButton(
             icon=ft.Icons.EDIT,
             icon_color=ft.Colors.WHITE,
@@ -271,7 +385,9 @@ class App:
         footer = ft.Container(
             ft.Column([
                 ft.Row([
+                    self.bandwidth_field,
                     self.sync_button,
+                    self.cancel_button,
                     self.edit_button,
                     self.back_button
                 ], alignment=ft.MainAxisAlignment.END),
@@ -286,5 +402,6 @@ class App:
 
     def window_event(self, e):
         if e.data == "close":
+            self.sync.cancel()
             self.page.window_destroy()
             sys.exit(0)
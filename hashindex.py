@@ -0,0 +1,74 @@
+from typing import Optional, Union
+import hashlib
+import json
+import os
+import threading
+from manifest import item_key
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+def file_hash(path: str) -> str:
+    digest = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_BUFFER_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class HashIndex:
+    def __init__(self, path: str, entries: Optional[dict] = None):
+        self.path = path
+        self.previous = entries or {}
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, manifest_dir: str, source: Union[str, list[str]], destination: str) -> 'HashIndex':
+        path = os.path.join(manifest_dir, f"{item_key(source, destination)}.hashes.json")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        return cls(path, entries)
+
+    def cached(self, path: str, file_stat: os.stat_result) -> Optional[str]:
+        key = [file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns]
+        with self._lock:
+            entry = self.entries.get(path) or self.previous.get(path)
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+        return None
+
+    def get(self, path: str, file_stat: os.stat_result) -> str:
+        digest = self.cached(path, file_stat)
+        if digest is None:
+            digest = file_hash(path)
+        self.set(path, file_stat, digest)
+        return digest
+
+    def set(self, path: str, file_stat: os.stat_result, digest: str):
+        with self._lock:
+            self.entries[path] = [file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, digest]
+
+    def discard(self, paths: list[str]):
+        with self._lock:
+            for path in paths:
+                self.entries.pop(path, None)
+                self.previous.pop(path, None)
+
+    def save(self):
+        # Entries not touched this run are kept: warm and watch-mode runs hash little or nothing
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({**self.previous, **self.entries}, f)
+        os.replace(tmp_path, self.path)
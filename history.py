@@ -0,0 +1,70 @@
+from typing import Optional
+import os
+import sqlite3
+import threading
+import time
+from logger import SyncStats, SyncMetrics, RunEstimate
+
+HISTORY_FILE = 'history.sqlite3'
+HISTORY_RUNS = 5
+HISTORY_KEEP = 50
+
+class RunHistory:
+    # Per-item results of earlier runs, keyed like the manifest (source + destination),
+    # so renaming an item in config.json keeps its history
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "key TEXT NOT NULL, name TEXT NOT NULL, finished REAL NOT NULL, duration REAL NOT NULL, "
+                "execute_seconds REAL NOT NULL, bytes INTEGER NOT NULL, files INTEGER NOT NULL, "
+                "files_seen INTEGER NOT NULL, errors INTEGER NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS runs_key ON runs (key, finished)")
+        return self._db
+
+    def record(self, key: str, name: str, stats: SyncStats, metrics: SyncMetrics, execute_seconds: float):
+        files_seen = stats.added + stats.updated + stats.deleted + stats.moved + stats.ignored
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, name, time.time(), metrics.duration, execute_seconds, metrics.bytes_copied, metrics.files_copied, files_seen, stats.errors),
+                )
+                db.execute(
+                    "DELETE FROM runs WHERE key = ? AND rowid NOT IN "
+                    "(SELECT rowid FROM runs WHERE key = ? ORDER BY finished DESC LIMIT ?)",
+                    (key, key, HISTORY_KEEP),
+                )
+
+    def estimate(self, key: str) -> Optional[RunEstimate]:
+        # Averages over the last few runs; throughput only counts time spent executing.
+        # Asking never creates the database, so dry runs leave nothing behind.
+        with self._lock:
+            if self._db is None and not os.path.exists(self.path):
+                return None
+            rows = self._connect().execute(
+                "SELECT duration, execute_seconds, bytes FROM runs WHERE key = ? ORDER BY finished DESC LIMIT ?",
+                (key, HISTORY_RUNS),
+            ).fetchall()
+        if not rows:
+            return None
+        duration = sum(row[0] for row in rows) / len(rows)
+        execute_seconds = sum(row[1] for row in rows)
+        copied = sum(row[2] for row in rows)
+        rate = copied / execute_seconds if execute_seconds > 0 and copied > 0 else None
+        return RunEstimate(duration=duration, rate=rate, runs=len(rows))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,52 @@
+from collections import deque
+from typing import Optional
+import time
+
+LOG_FILE = 'sync.log'
+LOG_LINES = 1000
+
+class LogBuffer:
+    # Keeps only the last max_lines lines in memory; every line reaches the log file
+    # once it falls out of the buffer or when the buffer is closed
+    def __init__(self, max_lines: int = LOG_LINES, path: Optional[str] = LOG_FILE):
+        self.lines = deque(maxlen=max_lines)
+        self.appended = 0
+        self.keys = {}
+        self.path = path
+        self.file = None
+        if path:
+            self.file = open(path, 'a', encoding='utf-8')
+            self.file.write(f"--- {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+    def append(self, line: str, key: Optional[str] = None):
+        if self.lines.maxlen and len(self.lines) == self.lines.maxlen:
+            self._write(self.lines[0])
+        self.lines.append(line)
+        self.appended += 1
+        if key is not None:
+            self.keys[key] = self.appended - 1
+
+    def replace(self, line: str, key: Optional[str] = None):
+        if key in self.keys:
+            index = self.keys[key] - (self.appended - len(self.lines))
+            if index >= 0:
+                self.lines[index] = line
+        elif self.lines:
+            self.lines[-1] = line
+        else:
+            self.append(line, key)
+
+    def text(self) -> str:
+        return "\n".join(self.lines)
+
+    def close(self):
+        if self.file is None:
+            return
+        for line in self.lines:
+            self._write(line)
+        self.file.close()
+        self.file = None
+
+    def _write(self, line: str):
+        if self.file is not None:
+            self.file.write(line + "\n")
@@ -1,5 +1,7 @@
 from dataclasses import dataclass, field
 from typing import Dict, Optional, Callable
+import heapq
+import threading
 import time
 
 @dataclass
@@ -7,21 +9,101 @@ class SyncStats:
     updated: int = 0
     added: int = 0
     deleted: int = 0
+    moved: int = 0
     ignored: int = 0
     errors: int = 0
+    strategies: Dict[str, int] = field(default_factory=dict)
+    delta_written: int = 0
+    delta_size: int = 0
+
+@dataclass
+class RunEstimate:
+    duration: float
+    rate: Optional[float]
+    runs: int
+
+@dataclass
+class SyncMetrics:
+    started: float = 0.0
+    finished: float = 0.0
+    phases: Dict[str, float] = field(default_factory=dict)
+    bytes_copied: int = 0
+    files_copied: int = 0
+    slowest: list = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return max(self.finished - self.started, 0.0)
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files_copied / self.duration if self.duration else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes_copied / 1048576 / self.duration if self.duration else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'duration': round(self.duration, 6),
+            'phases': {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+            'bytes_copied': self.bytes_copied,
+            'files_copied': self.files_copied,
+            'files_per_second': round(self.files_per_second, 3),
+            'mb_per_second': round(self.mb_per_second, 3),
+            'slowest': [[path, round(seconds, 6)] for seconds, path in sorted(self.slowest, reverse=True)],
+        }
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+class _PhaseTimer:
+    def __init__(self, logger: 'SyncLogger', phase: str, path: Optional[str]):
+        self.logger = logger
+        self.phase = phase
+        self.path = path
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.logger.add_phase_time(self.phase, time.perf_counter() - self.start, self.path)
+        return False
 
 class SyncLogger:
-    def __init__(self, progress_callback: Optional[Callable[[str, str], None]] = None, log_callback: Optional[Callable[[str], None]] = None):
+    def __init__(self, progress_callback: Optional[Callable[[str, str], None]] = None, log_callback: Optional[Callable[[str, bool, Optional[str]], None]] = None, parent: Optional['SyncLogger'] = None, metrics: bool = False, metrics_exporter=None, slowest_files: int = 10, quiet: bool = False):
         self.stats = SyncStats()
         self.current_group = ""
         self.current_item = ""
-        self.total_files = 0
-        self.processed_files = 0
+        self.total_bytes = 0
+        self.processed_bytes = 0
         self.start_time = 0
         self.dots = ""
         self.progress_callback = progress_callback
         self.log_callback = log_callback
         self.last_stats_update = 0
+        self.parent = parent
+        self.cancelled = False
+        self.estimate = None
+        self.execution_started = 0
+        self.metrics_exporter = metrics_exporter
+        self.metrics_enabled = metrics or metrics_exporter is not None
+        self.metrics = SyncMetrics()
+        self.slowest_files = slowest_files
+        self.quiet = quiet
+        self._lock = threading.RLock()
+
+    def child(self) -> 'SyncLogger':
+        # Logger for one of several concurrently running items: keeps its own stats and
+        # status line, and adds its byte counts to this logger's overall progress
+        return SyncLogger(self.progress_callback, self.log_callback, parent=self, metrics=self.metrics_enabled, metrics_exporter=self.metrics_exporter, slowest_files=self.slowest_files, quiet=self.quiet)
 
     def start_group(self, group_name: str):
         self.current_group = group_name
@@ -29,22 +111,50 @@ class SyncLogger:
         if self.progress_callback:
             self.progress_callback("0", "0")
         if self.log_callback:
-            self.log_callback(f"Синхронизация: {group_name}", True)
+            self.log_callback(f"Синхронизация: {group_name}", True, None)
 
-    def start_item(self, item_name: str, total_files: int):
+    def start_item(self, item_name: str, total_bytes: int = 0, estimate: Optional[RunEstimate] = None):
         self.current_item = item_name
-        self.total_files = total_files
-        self.processed_files = 0
         self.start_time = time.time()
+        self.estimate = estimate
+        self.execution_started = 0
         self.last_stats_update = 0
         self.stats = SyncStats()
+        self.metrics = SyncMetrics(started=time.perf_counter())
+        self.cancelled = False
+        if self.parent is None:
+            self.total_bytes = 0
+            self.processed_bytes = 0
         if self.log_callback:
-            self.log_callback(f"{self.current_item} ... ()", True)
+            self.log_callback(f"{self.current_item} ... ()", True, self.current_item)
+        self.set_total(total_bytes)
         self._update_progress(force=True)
 
-    def update_progress(self, file_count: int = 1):
-        self.processed_files += file_count
-        self._update_progress()
+    def start_execution(self, total_bytes: int):
+        self.execution_started = time.time()
+        self.set_total(total_bytes)
+
+    def set_total(self, total_bytes: int):
+        with self._lock:
+            delta = total_bytes - self.total_bytes
+            self.total_bytes = total_bytes
+            if self.parent is not None:
+                self.parent.add_progress(total_delta=delta)
+            self._update_progress()
+
+    def update_progress(self, size: int = 0):
+        with self._lock:
+            self.processed_bytes += size
+            if self.parent is not None:
+                self.parent.add_progress(processed_delta=size)
+            self._update_progress()
+
+    def add_progress(self, total_delta: int = 0, processed_delta: int = 0):
+        with self._lock:
+            self.total_bytes += total_delta
+            self.processed_bytes += processed_delta
+            if self.progress_callback:
+                self.progress_callback(str(self.processed_bytes), str(self.total_bytes))
 
     def _update_progress(self, force=False):
         now = time.time()
@@ -56,38 +166,122 @@ class SyncLogger:
                 stats.append(f"added: {self.stats.added}")
             if self.stats.deleted > 0:
                 stats.append(f"deleted: {self.stats.deleted}")
+            if self.stats.moved > 0:
+                stats.append(f"moved: {self.stats.moved}")
             if self.stats.ignored > 0:
                 stats.append(f"ignored: {self.stats.ignored}")
             if self.stats.errors > 0:
                 stats.append(f"errors: {self.stats.errors}")
+            if self.stats.delta_size > 0:
+                stats.append(f"delta: {self.stats.delta_written / 1048576:.1f}/{self.stats.delta_size / 1048576:.1f} MB")
+            for strategy, count in self.stats.strategies.items():
+                stats.append(f"{strategy}: {count}")
+            if self.metrics_enabled and self.metrics.bytes_copied > 0:
+                stats.append(f"{self.metrics.mb_per_second:.1f} MB/s")
+            eta = self._eta(now)
+            if eta is not None and eta >= 1:
+                stats.append(f"ETA {int(eta // 60)}:{int(eta % 60):02d}")
+            if self.cancelled:
+                stats.append("cancelled")
             stats_str = ", ".join(stats)
             if self.log_callback:
-                self.log_callback(f"{self.current_item} ... ({stats_str})", False)
+                self.log_callback(f"{self.current_item} ... ({stats_str})", False, self.current_item)
             self.last_stats_update = now
-        if self.progress_callback:
-            self.progress_callback(str(self.processed_files), str(self.total_files))
+        if self.progress_callback and self.parent is None:
+            self.progress_callback(str(self.processed_bytes), str(self.total_bytes))
+
+    def file_updated(self, strategy: Optional[str] = None, size: int = 0):
+        with self._lock:
+            self.stats.updated += 1
+            self._count_strategy(strategy)
+            self._count_copied(size)
+            self.update_progress(size)
+
+    def file_added(self, strategy: Optional[str] = None, size: int = 0):
+        with self._lock:
+            self.stats.added += 1
+            self._count_strategy(strategy)
+            self._count_copied(size)
+            self.update_progress(size)
 
-    def file_updated(self):
-        self.stats.updated += 1
-        self.update_progress()
+    def timer(self, phase: str, path: Optional[str] = None):
+        # Phase timings are summed across worker threads; with metrics off this is a shared no-op
+        if not self.metrics_enabled:
+            return NULL_TIMER
+        return _PhaseTimer(self, phase, path)
 
-    def file_added(self):
-        self.stats.added += 1
-        self.update_progress()
+    def add_phase_time(self, phase: str, seconds: float, path: Optional[str] = None):
+        with self._lock:
+            self.metrics.phases[phase] = self.metrics.phases.get(phase, 0.0) + seconds
+            if path is not None and self.slowest_files > 0:
+                if len(self.metrics.slowest) < self.slowest_files:
+                    heapq.heappush(self.metrics.slowest, (seconds, path))
+                elif seconds > self.metrics.slowest[0][0]:
+                    heapq.heapreplace(self.metrics.slowest, (seconds, path))
+
+    def _count_copied(self, size: int):
+        self.metrics.bytes_copied += size
+        self.metrics.files_copied += 1
+
+    def _eta(self, now: float) -> Optional[float]:
+        # While copying, remaining bytes over the rate seen so far (or the item's usual rate
+        # until a few seconds have passed); before that, the usual duration of the item
+        if self.metrics.finished:
+            return None
+        if self.execution_started:
+            remaining = self.total_bytes - self.processed_bytes
+            if remaining <= 0:
+                return None
+            elapsed = now - self.execution_started
+            rate = self.processed_bytes / elapsed if elapsed >= 3 and self.processed_bytes else None
+            if rate is None and self.estimate is not None:
+                rate = self.estimate.rate
+            return remaining / rate if rate else None
+        if self.estimate is not None:
+            return max(self.estimate.duration - (now - self.start_time), 0)
+        return None
+
+    def _count_strategy(self, strategy: Optional[str]):
+        if strategy:
+            self.stats.strategies[strategy] = self.stats.strategies.get(strategy, 0) + 1
+
+    def file_delta(self, written: int, size: int):
+        with self._lock:
+            self.stats.updated += 1
+            self.stats.delta_written += written
+            self.stats.delta_size += size
+            self._count_copied(written)
+            self.update_progress(size)
 
     def file_deleted(self):
-        self.stats.deleted += 1
-        self.update_progress()
+        with self._lock:
+            self.stats.deleted += 1
+            self.update_progress()
 
-    def file_ignored(self):
-        self.stats.ignored += 1
-        self.update_progress()
+    def file_moved(self):
+        with self._lock:
+            self.stats.moved += 1
+            self.update_progress()
 
-    def file_error(self):
-        self.stats.errors += 1
-        self.update_progress()
+    def file_ignored(self, file_count: int = 1):
+        with self._lock:
+            self.stats.ignored += file_count
+            self.update_progress()
+
+    def file_error(self, size: int = 0):
+        with self._lock:
+            self.stats.errors += 1
+            self.update_progress(size)
+
+    def item_cancelled(self):
+        with self._lock:
+            self.cancelled = True
 
     def finish_item(self):
-        self._update_progress(force=True)
-        if not self.progress_callback and not self.log_callback:
+        with self._lock:
+            self.metrics.finished = time.perf_counter()
+            self._update_progress(force=True)
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.export(self.current_item, self.stats, self.metrics)
+        if not self.progress_callback and not self.log_callback and not self.quiet:
             print() 
\ No newline at end of file
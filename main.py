@@ -1,25 +1,32 @@
-from typing import Union
 from dataclasses import dataclass
+import argparse
 import json
-from sync import Sync, SyncItem
-from gui import App
-import flet as ft
+import signal
+import threading
+import time
+from sync import Sync, SyncItem, expand_destinations
+from watcher import Watcher
+from throttle import parse_rate
+from metrics import JsonLinesExporter, PrometheusExporter, MultiExporter
 import os
+import sys
 
-@dataclass
-class SyncItem:
-    name: str
-    source: Union[str, list[str]]
-    destination: str
+EXIT_OK = 0
+EXIT_ERRORS = 1
+EXIT_USAGE = 2
+EXIT_CANCELLED = 130
+SETTINGS_KEY = '_settings'
 
 @dataclass
 class SyncGroup:
     name: str
     items: list[SyncItem]
 
-def load_config(config_path: str) -> list[SyncGroup]:
+def load_config(config_path: str) -> tuple[list[SyncGroup], dict]:
+    # The optional '_settings' entry holds run-wide options; every other key is a group
     with open(config_path, 'r', encoding='utf-8') as f:
         data = json.load(f)
+    settings = data.pop(SETTINGS_KEY, {})
     
     groups = []
     for group_name, items_data in data.items():
@@ -27,10 +34,11 @@ def load_config(config_path: str) -> list[SyncGroup]:
         for item_name, paths in items_data.items():
             source = paths[0]
             destination = paths[1]
-            items.append(SyncItem(name=item_name, source=source, destination=destination))
+            options = paths[2] if len(paths) > 2 else {}
+            items.append(SyncItem(name=item_name, source=source, destination=destination, **options))
         groups.append(SyncGroup(name=group_name, items=items))
     
-    return groups
+    return groups, settings
 
 def select_items(groups: list[SyncGroup]) -> list[SyncItem]:
     selected_items = []
@@ -58,10 +66,162 @@ def select_items(groups: list[SyncGroup]) -> list[SyncItem]:
     
     return selected_items
 
-if __name__ == '__main__':
-    if not os.path.exists('config.json'):
-        with open('config.json', 'w', encoding='utf-8') as f:
+def print_log(log: str, new_line: bool, key: str = None):
+    print(f"\n{log}" if new_line else f"\r{log}", end='', flush=True)
+
+def find_items(groups: list[SyncGroup], group_names: list[str], item_names: list[str]) -> list[SyncItem]:
+    # Items are picked by group name, by item name or by 'group/item'; nothing picked means everything
+    if not group_names and not item_names:
+        return [item for group in groups for item in group.items]
+    selected = []
+    for name in group_names:
+        group = next((group for group in groups if group.name == name), None)
+        if group is None:
+            raise KeyError(f"Неизвестная группа: {name}")
+        selected.extend(group.items)
+    for name in item_names:
+        group_name, _, item_name = name.rpartition('/')
+        matches = [item for group in groups if not group_name or group.name == group_name for item in group.items if item.name == item_name]
+        if not matches:
+            raise KeyError(f"Неизвестный элемент: {name}")
+        selected.extend(matches)
+    return list({id(item): item for item in selected}.values())
+
+class JsonReporter:
+    # One JSON object per line on stdout; log lines are passed through, progress is throttled
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last_progress = 0
+        self.last_value = None
+        self._lock = threading.Lock()
+
+    def emit(self, **event):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            print(line, flush=True)
+
+    def progress(self, current: str, total: str):
+        now = time.monotonic()
+        if (current, total) == self.last_value or (now - self.last_progress < self.interval and current != total):
+            return
+        self.last_progress = now
+        self.last_value = (current, total)
+        self.emit(event='progress', processed=int(current), total=int(total))
+
+    def log(self, text: str, new_line: bool, key: str = None):
+        self.emit(event='log', item=key, text=text, new_line=new_line)
+
+def run_headless(sync: Sync, items: list[SyncItem], reporter: JsonReporter = None) -> int:
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: sync.cancel())
+
+    missing = [item for item in expand_destinations(items) if not os.path.exists(item.destination)]
+    for item in missing:
+        if reporter is not None:
+            reporter.emit(event='error', item=item.name, text=f"Нет папки назначения: {item.destination}")
+        else:
+            print(f"Нет папки назначения: {item.destination}", file=sys.stderr)
+
+    if reporter is not None:
+        plans = sync.sync_items(items, reporter.progress, reporter.log)
+    else:
+        plans = sync.sync_items(items, log_callback=print_log)
+        print()
+
+    if sync.cancelled:
+        code = EXIT_CANCELLED
+    elif missing or any(plan.errors for plan in plans):
+        code = EXIT_ERRORS
+    else:
+        code = EXIT_OK
+    if reporter is not None:
+        reporter.emit(event='result', exit_code=code, items=[{
+            'name': plan.name,
+            'copied': len(plan.copies),
+            'moved': len(plan.moves),
+            'deleted': len(plan.deletes),
+            'ignored': plan.ignored,
+            'bytes': plan.total_bytes,
+            'errors': plan.errors,
+            'cancelled': plan.cancelled,
+        } for plan in plans])
+    return code
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Sync the folders listed in config.json; without options the GUI starts")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--headless', action='store_true', help="sync without the GUI")
+    parser.add_argument('--select', action='store_true', help="choose groups and items in the terminal, then sync")
+    parser.add_argument('--group', action='append', default=[], help="sync this group (repeatable)")
+    parser.add_argument('--item', action='append', default=[], help="sync this item, as NAME or GROUP/NAME (repeatable)")
+    parser.add_argument('--json', action='store_true', help="print progress and the result as JSON lines")
+    parser.add_argument('--dry-run', action='store_true', help="print what would change as JSON")
+    parser.add_argument('--watch', action='store_true', help="sync, then keep syncing changes as they happen")
+    parser.add_argument('--bwlimit', type=parse_rate, help="total bandwidth cap in bytes/s, K/M/G suffixes allowed")
+    parser.add_argument('--iops', type=parse_rate, help="cap on file operations per second (stat, create, delete, ...)")
+    parser.add_argument('--idle', action='store_true', help="run at idle I/O priority and lowest CPU priority")
+    parser.add_argument('--metrics-jsonl', metavar='PATH', help="append per-item metrics to this JSON lines file")
+    parser.add_argument('--metrics-prom', metavar='PATH', help="write per-item metrics to this Prometheus textfile-collector file")
+    parser.add_argument('--workers', type=int, help="files copied at the same time within an item (default 1)")
+    parser.add_argument('--jobs', type=int, help="items synced at the same time (default 1)")
+    parser.add_argument('--device-limit', type=int, help="items per disk at the same time when --jobs > 1 (default 1)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.config):
+        with open(args.config, 'w', encoding='utf-8') as f:
             f.write('{}')
-    groups = load_config('config.json')
-    app = App(groups)
-    ft.app(target=app.main, assets_dir=".")
+    try:
+        groups, settings = load_config(args.config)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Не удалось прочитать {args.config}: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    # Command-line options win over the '_settings' entry of the config
+    exporters = []
+    if args.metrics_jsonl or settings.get('metrics_jsonl'):
+        exporters.append(JsonLinesExporter(args.metrics_jsonl or settings['metrics_jsonl']))
+    if args.metrics_prom or settings.get('metrics_prom'):
+        exporters.append(PrometheusExporter(args.metrics_prom or settings['metrics_prom']))
+    exporter = exporters[0] if len(exporters) == 1 else MultiExporter(exporters) if exporters else None
+    sync = Sync(
+        workers=args.workers or settings.get('workers', 1),
+        metrics_exporter=exporter,
+        item_workers=args.jobs or settings.get('jobs', 1),
+        device_limit=args.device_limit or settings.get('device_limit', 1),
+        bandwidth=args.bwlimit or settings.get('bandwidth'),
+        iops=args.iops or settings.get('iops'),
+        idle_priority=args.idle or settings.get('idle', False),
+    )
+    sync.protect_destinations([item for group in groups for item in group.items])
+
+    if not (args.headless or args.select or args.group or args.item or args.json or args.dry_run or args.watch):
+        # The GUI stack is only imported when it is used, so headless runs start quickly
+        import flet as ft
+        from gui import App
+        app = App(groups, sync=sync)
+        ft.app(target=app.main, assets_dir=".")
+        return EXIT_OK
+
+    try:
+        items = select_items(groups) if args.select else find_items(groups, args.group, args.item)
+    except KeyError as e:
+        print(e.args[0], file=sys.stderr)
+        return EXIT_USAGE
+    reporter = JsonReporter() if args.json else None
+
+    if args.dry_run:
+        plans = sync.plan_items(items)
+        print(json.dumps([plan.to_dict() for plan in plans], ensure_ascii=False, indent=2))
+        return EXIT_OK
+    if args.watch:
+        watcher = Watcher(sync, items)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: watcher.stop())
+        if reporter is not None:
+            watcher.run(reporter.progress, reporter.log)
+        else:
+            watcher.run(log_callback=print_log)
+        return EXIT_OK
+    return run_headless(sync, items, reporter)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+from typing import Optional, Union
+import hashlib
+import json
+import os
+
+MANIFEST_DIR = '.sync_manifest'
+
+def item_key(source: Union[str, list[str]], destination: str) -> str:
+    return hashlib.sha1(f"{source}\0{destination}".encode('utf-8')).hexdigest()
+
+class Manifest:
+    def __init__(self, path: str, dirs: Optional[dict] = None):
+        self.path = path
+        self.previous = dirs or {}
+        self.dirs = {}
+
+    @classmethod
+    def load(cls, manifest_dir: str, source: str, destination: str) -> 'Manifest':
+        path = os.path.join(manifest_dir, f"{item_key(source, destination)}.json")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            dirs = data.get('dirs', {})
+        except (OSError, ValueError):
+            dirs = {}
+        return cls(path, dirs)
+
+    def is_unchanged(self, rel: str, mtime_ns: int, names: list[str], destination: str) -> bool:
+        record = self.previous.get(rel)
+        if record is None or record['mtime'] != mtime_ns:
+            return False
+        if set(record['dirs']) | set(record['files']) != set(names):
+            return False
+        return os.path.isdir(destination)
+
+    def file_unchanged(self, rel: str, name: str, size: int, mtime_ns: int) -> bool:
+        record = self.previous.get(rel)
+        if record is None:
+            return False
+        return record['files'].get(name) == [size, mtime_ns]
+
+    def keep(self, rel: str):
+        self.dirs[rel] = self.previous[rel]
+
+    def record(self, rel: str, mtime_ns: int, subdirs: list[str], files: dict[str, list[int]]):
+        self.dirs[rel] = {'mtime': mtime_ns, 'dirs': subdirs, 'files': files}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dirs': self.dirs}, f)
+        os.replace(tmp_path, self.path)
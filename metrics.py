@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+import time
+from logger import SyncStats, SyncMetrics
+
+class JsonLinesExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, item_name: str, stats: SyncStats, metrics: SyncMetrics):
+        record = {
+            'timestamp': time.time(),
+            'item': item_name,
+            'updated': stats.updated,
+            'added': stats.added,
+            'deleted': stats.deleted,
+            'moved': stats.moved,
+            'ignored': stats.ignored,
+            'errors': stats.errors,
+            **metrics.to_dict(),
+        }
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+class PrometheusExporter:
+    # Writes a node_exporter textfile-collector file; the whole file is rewritten atomically
+    def __init__(self, path: str):
+        self.path = path
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def export(self, item_name: str, stats: SyncStats, metrics: SyncMetrics):
+        with self._lock:
+            self.items[item_name] = (stats, metrics, time.time())
+            lines = []
+            for name, help_text, value in self._series():
+                lines.append(f"# HELP folder_sync_{name} {help_text}")
+                lines.append(f"# TYPE folder_sync_{name} gauge")
+                for item, (item_stats, item_metrics, finished) in sorted(self.items.items()):
+                    for labels, number in value(item_stats, item_metrics, finished):
+                        label_text = ','.join([f'item="{self._escape(item)}"'] + [f'{key}="{val}"' for key, val in labels])
+                        lines.append(f"folder_sync_{name}{{{label_text}}} {number}")
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, self.path)
+
+    def _series(self):
+        return [
+            ('last_run_timestamp_seconds', "Unix time the item last finished", lambda s, m, t: [((), t)]),
+            ('duration_seconds', "Wall time of the last run", lambda s, m, t: [((), m.duration)]),
+            ('phase_seconds', "Seconds per phase: scan, compare, copy and delete are summed over worker threads, planning and execution are wall time", lambda s, m, t: [((('phase', phase),), seconds) for phase, seconds in m.phases.items()]),
+            ('bytes_copied', "Bytes written in the last run", lambda s, m, t: [((), m.bytes_copied)]),
+            ('files_per_second', "Copied files per second in the last run", lambda s, m, t: [((), m.files_per_second)]),
+            ('megabytes_per_second', "Copy throughput of the last run", lambda s, m, t: [((), m.mb_per_second)]),
+            ('files', "File counts of the last run", lambda s, m, t: [((('result', key),), getattr(s, key)) for key in ('updated', 'added', 'deleted', 'moved', 'ignored', 'errors')]),
+        ]
+
+    def _escape(self, value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MultiExporter:
+    def __init__(self, exporters: list):
+        self.exporters = exporters
+
+    def export(self, item_name: str, stats: SyncStats, metrics: SyncMetrics):
+        for exporter in self.exporters:
+            exporter.export(item_name, stats, metrics)
@@ -0,0 +1,86 @@
+from dataclasses import dataclass, field
+import os
+import threading
+
+@dataclass
+class PlannedCopy:
+    source: str
+    destination: str
+    source_stat: os.stat_result
+    update: bool
+
+    @property
+    def size(self) -> int:
+        return self.source_stat.st_size
+
+@dataclass
+class PlannedMove:
+    # An add matched to a delete: the old destination file is renamed instead of recopied
+    copy: PlannedCopy
+    old_destination: str
+
+@dataclass
+class SyncPlan:
+    name: str
+    dirs: list[str] = field(default_factory=list)
+    copies: list[PlannedCopy] = field(default_factory=list)
+    deletes: list[str] = field(default_factory=list)
+    moves: list[PlannedMove] = field(default_factory=list)
+    extra_dirs: list[str] = field(default_factory=list)
+    # File-list sources skipped because an earlier source has the same name in the destination
+    collisions: list[str] = field(default_factory=list)
+    ignored: int = 0
+    errors: int = 0
+    cancelled: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add_dir(self, path: str):
+        with self._lock:
+            self.dirs.append(path)
+
+    def add_copy(self, copy: PlannedCopy):
+        with self._lock:
+            self.copies.append(copy)
+
+    def add_delete(self, path: str):
+        with self._lock:
+            self.deletes.append(path)
+
+    def add_extra_dir(self, path: str):
+        with self._lock:
+            self.extra_dirs.append(path)
+
+    def add_collision(self, path: str):
+        with self._lock:
+            self.collisions.append(path)
+
+    def add_ignored(self, count: int = 1):
+        with self._lock:
+            self.ignored += count
+
+    @property
+    def adds(self) -> list[PlannedCopy]:
+        return [copy for copy in self.copies if not copy.update]
+
+    @property
+    def updates(self) -> list[PlannedCopy]:
+        return [copy for copy in self.copies if copy.update]
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(copy.size for copy in self.copies)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'dirs': self.dirs,
+            'adds': [[copy.source, copy.destination, copy.size] for copy in self.adds],
+            'updates': [[copy.source, copy.destination, copy.size] for copy in self.updates],
+            'moves': [[move.old_destination, move.copy.destination, move.copy.size] for move in self.moves],
+            'deletes': self.deletes,
+            'extra_dirs': self.extra_dirs,
+            'collisions': self.collisions,
+            'ignored': self.ignored,
+            'errors': self.errors,
+            'total_bytes': self.total_bytes,
+        }
@@ -1,134 +1,999 @@
-from typing import Union
+from typing import Union, Optional, Callable, Iterator
+import errno
+import fnmatch
+import glob
 import os
-import shutil
-from dataclasses import dataclass
-from logger import SyncLogger
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field, fields, replace
+from functools import cached_property
+from logger import SyncLogger, RunEstimate
+from manifest import Manifest, MANIFEST_DIR, item_key
+from history import RunHistory, HISTORY_FILE
+from hashindex import HashIndex
+from copier import copy_file, copy_fanout, copy_metadata, delta_copy, partial_path, partial_stem, partial_target, sync_filesystem, CopyCancelled, COPY_BUFFER_SIZE, DELTA_BLOCK_SIZE
+from plan import SyncPlan, PlannedCopy, PlannedMove
+from filters import PathFilter, compile_filter
+from throttle import Throttle, lower_priority
 
-IGNORE_FOLDERS = ['.git', '.stfolder']
+SMALL_FILE_SIZE = 1024 * 1024
+BATCH_FILES = 64
+BATCH_BYTES = 16 * 1024 * 1024
 
 @dataclass
 class SyncItem:
     name: str
     source: Union[str, list[str]]
+    destination: Union[str, list[str]]
+    workers: Optional[int] = None
+    manifest: bool = True
+    prune: bool = False
+    buffer_size: Optional[int] = None
+    delta_threshold: Optional[int] = None
+    delta_block_size: int = DELTA_BLOCK_SIZE
+    compare: str = 'mtime'
+    detect_moves: bool = True
+    delete_extra_dirs: bool = True
+    durable: bool = True
+    exclude: list[str] = field(default_factory=list)
+    include: list[str] = field(default_factory=list)
+    bandwidth: Optional[float] = None
+    iops: Optional[float] = None
+
+    @cached_property
+    def path_filter(self) -> PathFilter:
+        return compile_filter(self.exclude, self.include)
+
+@dataclass
+class DirListing:
+    rel: str
+    source: str
     destination: str
+    files: list[os.DirEntry]
+    subdirs: list[str]
+    mtime_ns: int = 0
+
+@dataclass
+class SyncTarget:
+    # One destination of a sync run; items sharing a source are planned and copied together
+    item: SyncItem
+    logger: SyncLogger
+    plan: SyncPlan
+    hashes: Optional[HashIndex] = None
+    manifest: Optional[Manifest] = None
+
+def expand_destinations(items: list[SyncItem]) -> list[SyncItem]:
+    # An item declared with several destinations becomes one item per destination
+    expanded = []
+    for item in items:
+        if not isinstance(item.destination, list):
+            expanded.append(item)
+        elif len(item.destination) == 1:
+            expanded.append(replace(item, destination=item.destination[0]))
+        else:
+            expanded.extend(replace(item, name=f"{item.name} ({destination})", destination=destination) for destination in item.destination)
+    return expanded
+
+def item_names(item: SyncItem) -> set[str]:
+    # The names an item answers to: an expanded one keeps its configured name as well
+    suffix = f" ({item.destination})"
+    if item.name.endswith(suffix):
+        return {item.name, item.name[:-len(suffix)]}
+    return {item.name}
+
+def iter_file_list(paths: list[str]) -> Iterator[str]:
+    # Glob patterns in a file list are expanded lazily; literal paths are passed through
+    for path in paths:
+        if glob.has_magic(path):
+            yield from glob.iglob(path)
+        else:
+            yield path
+
+class FilePool:
+    def __init__(self, workers: int, initializer: Optional[Callable] = None):
+        self.workers = max(1, workers)
+        self._executor = None
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, initializer=initializer)
+        # Bound the queue so huge directories don't pile up millions of pending futures
+        self._slots = threading.BoundedSemaphore(self.workers * 4)
+        self._errors = []
+
+    def submit(self, fn: Callable, *args):
+        if self._executor is None:
+            fn(*args)
+            return
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _done(self, future: Future):
+        if future.exception() is not None:
+            self._errors.append(future.exception())
+        self._slots.release()
+
+    def join(self):
+        # Waits for everything submitted so far and re-raises the first failure, as workers=1 would
+        if self._executor is None:
+            return
+        for _ in range(self.workers * 4):
+            self._slots.acquire()
+        for _ in range(self.workers * 4):
+            self._slots.release()
+        if self._errors:
+            error = self._errors[0]
+            self._errors.clear()
+            raise error
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 class Sync:
-    def count_files(self, path: str) -> int:
-        if isinstance(path, list):
-            return len(path)
-        
-        if os.path.isfile(path):
-            return 1
-        
-        total = 0
-        for entry in os.scandir(path):
-            name = os.path.basename(entry.path)
-            if name in IGNORE_FOLDERS:
-                continue
-            if entry.is_file():
-                total += 1
-            elif entry.is_dir():
-                total += self.count_files(entry.path)
-        return total
-
-    def sync_items(self, items: list[SyncItem], progress_callback=None, log_callback=None):
-        logger = SyncLogger(progress_callback, log_callback)
-        
+    def __init__(self, workers: int = 1, manifest_dir: str = MANIFEST_DIR, buffer_size: int = COPY_BUFFER_SIZE, item_workers: int = 1, device_limit: int = 1, metrics: bool = False, metrics_exporter=None, history: bool = True, bandwidth: Optional[float] = None, iops: Optional[float] = None, idle_priority: bool = False):
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.manifest_dir = manifest_dir
+        self.item_workers = item_workers
+        self.device_limit = device_limit
+        self.metrics = metrics
+        self.metrics_exporter = metrics_exporter
+        self._device_slots = {}
+        self._device_lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._destinations = set()
+        self._protected = set()
+        self._file_list_claims = {}
+        self.history = RunHistory(os.path.join(manifest_dir, HISTORY_FILE)) if history else None
+        self.idle_priority = idle_priority
+        self.throttle = Throttle(bandwidth, iops)
+        self._item_throttles = {}
+        self._item_limits = {}
+        self._throttle_lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def protect_destinations(self, items: list[SyncItem]):
+        # Every configured item, not only those selected for a run: a nested destination of an
+        # item that isn't being synced right now must survive pruning too
+        self._protected = {self._dir_key(item.destination) for item in expand_destinations(items)}
+        self._destinations |= self._protected
+
+    def cancel(self):
+        # Stops the current run between files: copies in flight finish, nothing new starts
+        self._cancelled.set()
+
+    def set_bandwidth(self, rate: Optional[float], item: Optional[str] = None):
+        # Bytes per second for the whole sync or one item by name; None lifts the cap. Copies in
+        # flight pick it up at their next segment, except files under RESUME_THRESHOLD that
+        # started uncapped, which are copied in one call.
+        self._set_limit('bandwidth', rate, item)
+
+    def set_iops(self, rate: Optional[float], item: Optional[str] = None):
+        self._set_limit('iops', rate, item)
+
+    def _set_limit(self, kind: str, rate: Optional[float], name: Optional[str]):
+        if name is None:
+            getattr(self.throttle, kind).set_rate(rate)
+            return
+        with self._throttle_lock:
+            self._item_limits.setdefault(name, {})[kind] = rate
+            for names, throttle in self._item_throttles.values():
+                if name in names:
+                    getattr(throttle, kind).set_rate(rate)
+
+    def _throttle(self, item: SyncItem) -> Throttle:
+        # One per source and destination, so same-named items of different groups stay apart.
+        # Created on first use from the item's options; a limit set by name before that wins.
+        key = item_key(item.source, item.destination)
+        entry = self._item_throttles.get(key)
+        if entry is None:
+            with self._throttle_lock:
+                if key not in self._item_throttles:
+                    names = item_names(item)
+                    throttle = Throttle(item.bandwidth, item.iops, self.throttle)
+                    for name in names:
+                        for kind, rate in self._item_limits.get(name, {}).items():
+                            getattr(throttle, kind).set_rate(rate)
+                    self._item_throttles[key] = (names, throttle)
+                entry = self._item_throttles[key]
+        return entry[1]
+
+    def _worker_initializer(self) -> Optional[Callable]:
+        return lower_priority if self.idle_priority else None
+
+    def sync_items(self, items: list[SyncItem], progress_callback=None, log_callback=None, dry_run: bool = False) -> list[SyncPlan]:
+        self._cancelled.clear()
+        if self.idle_priority:
+            lower_priority()
+        # A dry run's output is the plan itself (main prints it as JSON), so nothing else goes to stdout
+        logger = SyncLogger(progress_callback, log_callback, metrics=self.metrics, metrics_exporter=self.metrics_exporter, quiet=dry_run)
+        items = [item for item in expand_destinations(items) if os.path.exists(item.destination)]
+        # Another item's destination nested in this one's is never pruned as an extra directory
+        self._destinations = self._protected | {self._dir_key(item.destination) for item in items}
+        groups = self._fanout_groups(items)
+
+        if self.item_workers <= 1 or len(groups) <= 1:
+            results = [self._sync_targets(group, self._group_loggers(group, logger), dry_run) for group in groups]
+        else:
+            # Longest first, so a big item doesn't start last and hold up the whole run;
+            # items without history count as long, since nothing is known about them
+            groups.sort(key=lambda group: max(self._expected_duration(item) for item in group), reverse=True)
+            with ThreadPoolExecutor(max_workers=self.item_workers, initializer=self._worker_initializer()) as executor:
+                results = list(executor.map(lambda group: self._sync_scheduled(group, [logger.child() for _ in group], dry_run), groups))
+        return [plan for plans in results for plan in plans]
+
+    def _fanout_groups(self, items: list[SyncItem]) -> list[list[SyncItem]]:
+        # Items that differ only in name and destination share one scan of their source
+        groups = {}
         for item in items:
-            if not os.path.exists(item.destination):
-                continue
+            key = repr([getattr(item, item_field.name) for item_field in fields(item) if item_field.name not in ('name', 'destination')])
+            groups.setdefault(key, []).append(item)
+        return list(groups.values())
 
-            if isinstance(item.source, list):
-                self._sync_file_list(item, logger)
-            else:
-                self._sync_directory(item, logger)
-            logger.finish_item()
+    def _estimate(self, item: SyncItem) -> Optional[RunEstimate]:
+        if self.history is None:
+            return None
+        try:
+            return self.history.estimate(item_key(item.source, item.destination))
+        except sqlite3.Error:
+            return None
+
+    def _expected_duration(self, item: SyncItem) -> float:
+        estimate = self._estimate(item)
+        return estimate.duration if estimate is not None else float('inf')
+
+    def _group_loggers(self, items: list[SyncItem], logger: SyncLogger) -> list[SyncLogger]:
+        return [logger] if len(items) == 1 else [logger.child() for _ in items]
 
-    def _sync_file_list(self, item: SyncItem, logger: SyncLogger):
-        logger.start_item(item.name, len(item.source))
-        for source_file in item.source:
-            if not os.path.exists(source_file):
+    def _sync_scheduled(self, items: list[SyncItem], loggers: list[SyncLogger], dry_run: bool = False) -> list[SyncPlan]:
+        # Devices are always taken in st_dev order, so two items sharing disks can't deadlock
+        devices = set().union(*(self._item_devices(item) for item in items))
+        slots = [self._device_slot(device) for device in sorted(devices)]
+        for slot in slots:
+            slot.acquire()
+        try:
+            if self.cancelled:
+                return []
+            return self._sync_targets(items, loggers, dry_run)
+        finally:
+            for slot in reversed(slots):
+                slot.release()
+
+    def _item_devices(self, item: SyncItem) -> set[int]:
+        paths = [item.destination]
+        if isinstance(item.source, list):
+            paths.extend({os.path.dirname(os.path.abspath(path)) for path in item.source})
+        else:
+            paths.append(item.source)
+        devices = set()
+        for path in paths:
+            try:
+                devices.add(os.stat(path).st_dev)
+            except OSError:
+                pass
+        return devices
+
+    def _device_slot(self, device: int) -> threading.Semaphore:
+        with self._device_lock:
+            if device not in self._device_slots:
+                self._device_slots[device] = threading.Semaphore(self.device_limit)
+            return self._device_slots[device]
+
+    def plan_items(self, items: list[SyncItem], log_callback=None) -> list[SyncPlan]:
+        return self.sync_items(items, log_callback=log_callback, dry_run=True)
+
+    def sync_changes(self, item: SyncItem, changes: dict[str, bool], logger: SyncLogger):
+        # Partial run for watch mode: keys are changed source files for file lists, or
+        # relative directories (value = include subdirectories) for directory items
+        items = [target for target in expand_destinations([item]) if os.path.exists(target.destination)]
+        if self.idle_priority:
+            lower_priority()
+        if items:
+            self._sync_targets(items, self._group_loggers(items, logger), changes=changes)
+
+    def _sync_targets(self, items: list[SyncItem], loggers: list[SyncLogger], dry_run: bool = False, changes: Optional[dict[str, bool]] = None) -> list[SyncPlan]:
+        # All items share source and options, so the source is scanned once for every destination
+        first = items[0]
+        is_list = isinstance(first.source, list)
+        if self.cancelled:
+            return []
+        try:
+            if not is_list and changes is None and self._is_directory_empty(first.source, first.path_filter):
+                return []
+        except OSError:
+            # A missing or unmounted source fails its items only; the rest of the run goes on
+            plans = []
+            for item, logger in zip(items, loggers):
+                logger.start_item(item.name)
                 logger.file_error()
+                logger.finish_item()
+                plans.append(SyncPlan(item.name, errors=1))
+            return plans
+
+        targets = []
+        for item, logger in zip(items, loggers):
+            logger.start_item(item.name, estimate=self._estimate(item))
+            target = SyncTarget(item, logger, SyncPlan(item.name))
+            if item.compare == 'hash':
+                target.hashes = HashIndex.load(self.manifest_dir, item.source, item.destination)
+            if item.manifest and not is_list and changes is None:
+                target.manifest = Manifest.load(self.manifest_dir, item.source, item.destination)
+            targets.append(target)
+
+        with FilePool(first.workers or self.workers, self._worker_initializer()) as pool:
+            with self._timer(targets, 'planning'):
+                if is_list:
+                    self._plan_file_list(targets, pool, changes)
+                else:
+                    self._plan_directory(targets, pool, changes)
+                pool.join()
+                if first.detect_moves and not self.cancelled:
+                    for target in targets:
+                        self._plan_moves(target.plan, target.hashes)
+
+            execute_seconds = 0.0
+            if not dry_run and not self.cancelled:
+                started = time.perf_counter()
+                with self._timer(targets, 'execution'):
+                    self._execute_targets(targets, pool)
+                execute_seconds = time.perf_counter() - started
+                for target in targets:
+                    plan = target.plan
+                    if target.item.durable and (plan.copies or plan.moves or plan.deletes):
+                        try:
+                            with target.logger.timer('flush'):
+                                sync_filesystem(target.item.destination)
+                        except OSError:
+                            target.logger.file_error()
+
+        for target in targets:
+            if target.hashes is not None and not dry_run:
+                target.hashes.discard(target.plan.deletes + [move.old_destination for move in target.plan.moves])
+                target.hashes.save()
+            if target.manifest is not None and not dry_run and not self.cancelled and target.logger.stats.errors == 0:
+                target.manifest.save()
+            if self.cancelled:
+                target.logger.item_cancelled()
+            target.plan.errors = target.logger.stats.errors
+            target.plan.cancelled = self.cancelled
+            target.logger.finish_item()
+            if self.history is not None and not dry_run and not self.cancelled and changes is None:
+                self._record_history(target, execute_seconds)
+        return [target.plan for target in targets]
+
+    def _record_history(self, target: SyncTarget, execute_seconds: float):
+        item = target.item
+        try:
+            self.history.record(item_key(item.source, item.destination), item.name, target.logger.stats, target.logger.metrics, execute_seconds)
+        except sqlite3.Error:
+            pass
+
+    def _timer(self, targets: list[SyncTarget], phase: str, path: Optional[str] = None):
+        if len(targets) == 1:
+            return targets[0].logger.timer(phase, path)
+        timers = ExitStack()
+        for target in targets:
+            timers.enter_context(target.logger.timer(phase, path))
+        return timers
+
+    def _plan_file_list(self, targets: list[SyncTarget], pool: FilePool, changes: Optional[dict[str, bool]] = None):
+        first = targets[0].item
+        if changes is not None:
+            # Watch mode names only the few files that changed, so they are looked up one by one,
+            # against the destination names claimed by the last full run
+            claimed = self._file_list_claims.get(tuple(first.source))
+            if claimed is None:
+                _, claimed = self._group_file_list(targets, first.path_filter)
+                self._file_list_claims[tuple(first.source)] = claimed
+            for source_file in changes:
+                if self.cancelled:
+                    break
+                name = os.path.basename(source_file)
+                if first.path_filter.file_excluded(name):
+                    continue
+                if claimed.setdefault(name, os.path.abspath(source_file)) != os.path.abspath(source_file):
+                    self._file_collision(targets, os.path.abspath(source_file))
+                    continue
+                pool.submit(self._plan_file, targets, source_file)
+            return
+
+        # Every source directory and each destination is listed once, so the cost follows
+        # the number of directories rather than the number of files
+        listed = []
+        for target in targets:
+            self._throttle(target.item).consume_ops()
+            try:
+                with target.logger.timer('scan'):
+                    dest_files, _ = self._list_destination(target.item.destination, '', first.path_filter)
+            except OSError:
+                target.logger.file_error()
                 continue
-            
-            dest_file = os.path.join(item.destination, os.path.basename(source_file))
-            self._sync_file(source_file, dest_file, logger)
-
-    def _sync_file(self, source_file: str, dest_file: str, logger: SyncLogger):
-        if os.path.exists(dest_file):
-            source_stat = os.stat(source_file)
-            dest_stat = os.stat(dest_file)
-            source_mtime = int(source_stat.st_mtime // 60)
-            dest_mtime = int(dest_stat.st_mtime // 60)
-            if source_stat.st_size == dest_stat.st_size and source_mtime == dest_mtime:
-                logger.file_ignored()
+            listed.append((target, dest_files))
+        if not listed:
+            return
+
+        directories, claimed = self._group_file_list(targets, first.path_filter)
+        self._file_list_claims[tuple(first.source)] = claimed
+        # A path can be named more than once (literally and by a pattern, or by two patterns)
+        batched = set()
+        throttle = self._throttle(first)
+        for directory, names in directories.items():
+            literal_dir = not glob.has_magic(directory)
+            for source_dir in ([directory] if literal_dir else glob.iglob(directory)):
+                if self.cancelled:
+                    return
+                throttle.consume_ops()
+                try:
+                    with self._timer(targets, 'scan'):
+                        entries = self._list_source_files(source_dir)
+                except OSError:
+                    entries = {}
+                batch = []
+                for name in names:
+                    if literal_dir and not glob.has_magic(name):
+                        # A literal path, claimed up front: missing means an error, as with any listed file
+                        if name in batched:
+                            continue
+                        if name in entries:
+                            batched.add(name)
+                            batch.append(entries[name])
+                        else:
+                            for target in targets:
+                                target.logger.file_error()
+                        continue
+                    if glob.has_magic(name):
+                        hidden = name.startswith('.')
+                        matches = [match for match in sorted(fnmatch.filter(entries, name)) if hidden or not match.startswith('.')]
+                    else:
+                        matches = [name] if name in entries else []
+                    for match in matches:
+                        path = entries[match].path
+                        if first.path_filter.file_excluded(match):
+                            continue
+                        if claimed.setdefault(match, path) != path:
+                            self._file_collision(targets, path)
+                        elif match not in batched:
+                            batched.add(match)
+                            batch.append(entries[match])
+                for start in range(0, len(batch), BATCH_FILES):
+                    pool.submit(self._plan_list_entries, listed, batch[start:start + BATCH_FILES])
+
+    def _group_file_list(self, targets: list[SyncTarget], path_filter: PathFilter) -> tuple[dict[str, dict[str, None]], dict[str, str]]:
+        # Source directory -> names and patterns in it. Literal paths claim their destination
+        # name up front, so two sources that would land on one file are caught before anything
+        # is copied; the first one listed wins. Names from patterns are claimed during the walk.
+        directories = {}
+        claimed = {}
+        for path in targets[0].item.source:
+            directory, name = os.path.split(os.path.abspath(path))
+            if not glob.has_magic(name) and path_filter.file_excluded(name):
+                continue
+            if not glob.has_magic(directory) and not glob.has_magic(name):
+                if claimed.setdefault(name, os.path.join(directory, name)) != os.path.join(directory, name):
+                    self._file_collision(targets, os.path.join(directory, name))
+                    continue
+            directories.setdefault(directory, {})[name] = None
+        return directories, claimed
+
+    def _file_collision(self, targets: list[SyncTarget], path: str):
+        for target in targets:
+            target.plan.add_collision(path)
+            target.logger.file_error()
+
+    def _list_source_files(self, path: str) -> dict[str, os.DirEntry]:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries if entry.is_file()}
+
+    def _plan_list_entries(self, listed: list[tuple[SyncTarget, dict[str, os.DirEntry]]], entries: list[os.DirEntry]):
+        targets = [target for target, _ in listed]
+        throttle = self._throttle(targets[0].item)
+        for entry in entries:
+            if self.cancelled:
+                return
+            throttle.consume_ops()
+            with self._timer(targets, 'compare'):
+                try:
+                    source_stat = entry.stat()
+                except OSError:
+                    for target in targets:
+                        target.logger.file_error()
+                    continue
+                for target, dest_files in listed:
+                    dest_entry = dest_files.get(entry.name)
+                    if dest_entry is not None:
+                        self._throttle(target.item).consume_ops()
+                    try:
+                        dest_stat = dest_entry.stat() if dest_entry is not None else None
+                    except OSError:
+                        target.logger.file_error()
+                        continue
+                    dest_file = os.path.join(target.item.destination, entry.name)
+                    self._plan_copy(target.plan, entry.path, dest_file, source_stat, dest_stat, target.logger, target.hashes)
+
+    def _plan_directory(self, targets: list[SyncTarget], pool: FilePool, changes: Optional[dict[str, bool]] = None):
+        first = targets[0].item
+        for rel, recursive in (changes or {'': True}).items():
+            source_dir = os.path.join(first.source, rel)
+            if changes is not None and (not os.path.isdir(source_dir) or self._dir_excluded(rel, first.path_filter)):
+                continue
+            dest_dir = os.path.join(first.destination, rel)
+            for listing in self._walk(source_dir, dest_dir, targets[0].logger, first.path_filter, first.prune, rel, recursive, self._throttle(first)):
+                for target in targets:
+                    target_listing = listing
+                    if target is not targets[0]:
+                        target_listing = replace(listing, destination=os.path.join(target.item.destination, listing.rel))
+                    self._plan_listing(target.item, target_listing, target.plan, target.logger, pool, target.hashes, target.manifest)
+
+    def _plan_file(self, targets: list[SyncTarget], source_file: str):
+        if self.cancelled:
+            return
+        with self._timer(targets, 'compare'):
+            self._throttle(targets[0].item).consume_ops()
+            try:
+                source_stat = os.stat(source_file)
+            except Exception:
+                for target in targets:
+                    target.logger.file_error()
                 return
+            for target in targets:
+                dest_file = os.path.join(target.item.destination, os.path.basename(source_file))
+                self._throttle(target.item).consume_ops()
+                try:
+                    dest_stat = os.stat(dest_file)
+                except FileNotFoundError:
+                    dest_stat = None
+                except Exception:
+                    target.logger.file_error()
+                    continue
+                self._plan_copy(target.plan, source_file, dest_file, source_stat, dest_stat, target.logger, target.hashes)
+
+    def _plan_entry(self, item: SyncItem, plan: SyncPlan, source_entry: os.DirEntry, dest_entry: Optional[os.DirEntry], dest_file: str, logger: SyncLogger, hashes: Optional[HashIndex] = None):
+        # DirEntry caches its stat result (free on Windows), so no extra round-trips here
+        if self.cancelled:
+            return
+        self._throttle(item).consume_ops()
+        with logger.timer('compare'):
             try:
-                shutil.copy2(source_file, dest_file)
-                os.utime(dest_file, (source_stat.st_atime, source_stat.st_mtime))
-                logger.file_updated()
+                source_stat = source_entry.stat()
+                dest_stat = dest_entry.stat() if dest_entry is not None else None
             except Exception:
                 logger.file_error()
-        else:
+                return
+            self._plan_copy(plan, source_entry.path, dest_file, source_stat, dest_stat, logger, hashes)
+
+    def _plan_copy(self, plan: SyncPlan, source_file: str, dest_file: str, source_stat: os.stat_result, dest_stat: Optional[os.stat_result], logger: SyncLogger, hashes: Optional[HashIndex] = None):
+        if dest_stat is not None:
             try:
-                shutil.copy2(source_file, dest_file)
-                source_stat = os.stat(source_file)
-                os.utime(dest_file, (source_stat.st_atime, source_stat.st_mtime))
-                logger.file_added()
+                same = self._is_same(source_file, dest_file, source_stat, dest_stat, hashes)
             except Exception:
                 logger.file_error()
+                return
+            if same:
+                plan.add_ignored()
+                logger.file_ignored()
+                return
+        plan.add_copy(PlannedCopy(source_file, dest_file, source_stat, dest_stat is not None))
+
+    def _is_same(self, source_file: str, dest_file: str, source_stat: os.stat_result, dest_stat: os.stat_result, hashes: Optional[HashIndex] = None) -> bool:
+        if source_stat.st_size != dest_stat.st_size:
+            return False
+        if hashes is not None:
+            return hashes.get(source_file, source_stat) == hashes.get(dest_file, dest_stat)
+        source_mtime = int(source_stat.st_mtime // 60)
+        dest_mtime = int(dest_stat.st_mtime // 60)
+        return source_mtime == dest_mtime
 
-    def _sync_directory(self, item: SyncItem, logger: SyncLogger):
-        if self._is_directory_empty(item.source):
+    def _plan_moves(self, plan: SyncPlan, hashes: Optional[HashIndex] = None):
+        # A new destination path whose source matches a file about to be deleted is renamed there
+        # instead of recopied. Hash-compared items must match in content; otherwise size and mtime
+        # are not proof enough (extracted archives share mtimes), so only a lone candidate with
+        # the same file name and no other add of that size and mtime counts as a move.
+        adds = plan.adds
+        if not adds or not plan.deletes:
             return
+        candidates = {}
+        for path in plan.deletes:
+            try:
+                dest_stat = os.stat(path)
+            except OSError:
+                continue
+            candidates.setdefault((dest_stat.st_size, dest_stat.st_mtime_ns), []).append((path, dest_stat))
+        add_counts = {}
+        for copy in adds:
+            key = (copy.size, copy.source_stat.st_mtime_ns)
+            add_counts[key] = add_counts.get(key, 0) + 1
 
-        total_files = self.count_files(item.source)
-        logger.start_item(item.name, total_files)
+        for copy in adds:
+            key = (copy.size, copy.source_stat.st_mtime_ns)
+            matches = candidates.get(key)
+            if not matches:
+                continue
+            if hashes is None and (len(matches) != 1 or add_counts[key] != 1):
+                continue
+            match = self._match_move(copy, matches, hashes)
+            if match is not None:
+                matches.remove(match)
+                plan.moves.append(PlannedMove(copy, match[0]))
+        if plan.moves:
+            moved_copies = {id(move.copy) for move in plan.moves}
+            moved_paths = {move.old_destination for move in plan.moves}
+            plan.copies = [copy for copy in plan.copies if id(copy) not in moved_copies]
+            plan.deletes = [path for path in plan.deletes if path not in moved_paths]
 
-        self._sync_directory_recursive(item, logger)
+    def _match_move(self, copy: PlannedCopy, matches: list[tuple[str, os.stat_result]], hashes: Optional[HashIndex] = None) -> Optional[tuple[str, os.stat_result]]:
+        # Prefer a candidate with the same file name, which is what a renamed folder looks like
+        name = os.path.basename(copy.destination)
+        if hashes is None:
+            return next((match for match in matches if os.path.basename(match[0]) == name), None)
+        for match in sorted(matches, key=lambda match: os.path.basename(match[0]) != name):
+            try:
+                if hashes.get(copy.source, copy.source_stat) == hashes.get(match[0], match[1]):
+                    return match
+            except OSError:
+                return None
+        return None
 
-    def _sync_directory_recursive(self, item: SyncItem, logger: SyncLogger):
-        os.makedirs(item.destination, exist_ok=True)
+    def execute(self, item: SyncItem, plan: SyncPlan, logger: SyncLogger, pool: FilePool, hashes: Optional[HashIndex] = None):
+        deletes = self._execute_transfers(item, plan, logger, pool, hashes)
+        pool.join()
+        if not self.cancelled:
+            self._execute_deletes(plan, deletes, logger, pool, self._throttle(item))
 
-        self._copy_source_files(item.source, item.destination, logger)
-        self._remove_extra_files(item.source, item.destination, logger)
+    def _execute_targets(self, targets: list[SyncTarget], pool: FilePool):
+        if len(targets) == 1:
+            target = targets[0]
+            self.execute(target.item, target.plan, target.logger, pool, target.hashes)
+            return
 
-        for subdir in self._get_subdirectories(item.source):
-            source_subdir = os.path.join(item.source, subdir)
-            dest_subdir = os.path.join(item.destination, subdir)
-            self._sync_directory_recursive(SyncItem(name=subdir, source=source_subdir, destination=dest_subdir), logger)
+        # A file going to several destinations is read once and written to all of them
+        fanouts = self._fanout_copies(targets)
+        shared = {id(copy) for group in fanouts for _, copy in group}
+        pending = [self._execute_transfers(target.item, target.plan, target.logger, pool, target.hashes, shared) for target in targets]
+        self._submit_batches(pool, fanouts, lambda group: group[0][1].size, self._execute_fanouts)
+        pool.join()
+        if self.cancelled:
+            return
+        for target, deletes in zip(targets, pending):
+            self._execute_deletes(target.plan, deletes, target.logger, pool, self._throttle(target.item))
 
-    def _is_directory_empty(self, path: str) -> bool:
-        for entry in os.scandir(path):
-            if os.path.basename(entry.path) in IGNORE_FOLDERS:
+    def _execute_transfers(self, item: SyncItem, plan: SyncPlan, logger: SyncLogger, pool: FilePool, hashes: Optional[HashIndex] = None, skip: Optional[set[int]] = None) -> list[str]:
+        # Submits directories, renames and copies (except those in skip); returns the deletes to run
+        # once every copy has landed
+        logger.start_execution(plan.total_bytes)
+        throttle = self._throttle(item)
+
+        for directory in plan.dirs:
+            throttle.consume_ops()
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except Exception:
+                logger.file_error()
+
+        # Renames go first: they are cheap, and a failed one falls back to copy plus delete
+        copies = plan.copies
+        deletes = plan.deletes
+        if plan.moves:
+            copies = list(copies)
+            deletes = list(deletes)
+            for move in plan.moves:
+                if self.cancelled:
+                    break
+                throttle.consume_ops()
+                if not self._execute_move(move, logger, hashes):
+                    logger.add_progress(move.copy.size, 0)
+                    copies.append(move.copy)
+                    deletes.append(move.old_destination)
+        if skip:
+            copies = [copy for copy in copies if id(copy) not in skip]
+
+        self._submit_batches(pool, copies, lambda copy: copy.size, lambda batch: self._execute_copies(item, batch, logger, hashes))
+        return deletes
+
+    def _submit_batches(self, pool: FilePool, entries: list, size: Callable, run: Callable):
+        # Largest files first so the long transfers overlap; small files go in batches
+        # to keep per-task overhead down
+        batch = []
+        batch_bytes = 0
+        for entry in sorted(entries, key=size, reverse=True):
+            if self.cancelled:
+                break
+            if size(entry) >= SMALL_FILE_SIZE:
+                pool.submit(run, [entry])
+                continue
+            batch.append(entry)
+            batch_bytes += size(entry)
+            if len(batch) >= BATCH_FILES or batch_bytes >= BATCH_BYTES:
+                pool.submit(run, batch)
+                batch = []
+                batch_bytes = 0
+        if batch:
+            pool.submit(run, batch)
+
+    def _execute_deletes(self, plan: SyncPlan, deletes: list[str], logger: SyncLogger, pool: FilePool, throttle: Throttle):
+        for start in range(0, len(deletes), BATCH_FILES):
+            pool.submit(self._remove_files, deletes[start:start + BATCH_FILES], logger, throttle)
+        pool.join()
+
+        # Deepest first; a directory still holding ignored folders or failed deletes stays
+        for path in reversed(plan.extra_dirs):
+            throttle.consume_ops()
+            try:
+                os.rmdir(path)
+            except OSError as e:
+                if e.errno != errno.ENOTEMPTY:
+                    logger.file_error()
+
+    def _fanout_copies(self, targets: list[SyncTarget]) -> list[list[tuple[SyncTarget, PlannedCopy]]]:
+        # Delta updates only rewrite changed blocks, so those stay per destination
+        by_source = {}
+        for target in targets:
+            item = target.item
+            for copy in target.plan.copies:
+                if copy.update and item.delta_threshold is not None and copy.size >= item.delta_threshold:
+                    continue
+                by_source.setdefault(copy.source, []).append((target, copy))
+        return [group for group in by_source.values() if len(group) > 1]
+
+    def _execute_fanouts(self, groups: list[list[tuple[SyncTarget, PlannedCopy]]]):
+        for group in groups:
+            if self.cancelled:
+                return
+            source = group[0][1].source
+            with self._timer([target for target, _ in group], 'copy', source):
+                self._execute_fanout(group)
+
+    def _execute_fanout(self, group: list[tuple[SyncTarget, PlannedCopy]]):
+        first = group[0][1]
+        item = group[0][0].item
+        buffer_size = item.buffer_size or self.buffer_size
+        for target, _ in group:
+            self._throttle(target.item).consume_ops()
+        try:
+            # The source is read once, so its bytes count once, against the first destination's item
+            errors = copy_fanout(first.source, [copy.destination for _, copy in group], first.source_stat, buffer_size, self._cancelled.is_set, self._throttle(item))
+        except CopyCancelled:
+            return
+        except Exception as e:
+            errors = [e] * len(group)
+        for (target, copy), error in zip(group, errors):
+            if error is not None:
+                target.logger.file_error(copy.size)
                 continue
+            self._remember_hash(copy.source, copy.destination, copy.source_stat, target.hashes)
+            if copy.update:
+                target.logger.file_updated('fanout', copy.size)
+            else:
+                target.logger.file_added('fanout', copy.size)
+
+    def _execute_move(self, move: PlannedMove, logger: SyncLogger, hashes: Optional[HashIndex] = None) -> bool:
+        copy = move.copy
+        try:
+            with logger.timer('move'):
+                os.rename(move.old_destination, copy.destination)
+                copy_metadata(copy.destination, copy.source_stat)
+        except OSError:
             return False
+        self._remember_hash(copy.source, copy.destination, copy.source_stat, hashes)
+        logger.file_moved()
         return True
 
-    def _copy_source_files(self, source: str, destination: str, logger: SyncLogger):
-        for entry in os.scandir(source):
-            if entry.is_file():
-                source_file = entry.path
-                dest_file = os.path.join(destination, entry.name)
-                self._sync_file(source_file, dest_file, logger)
+    def _execute_copies(self, item: SyncItem, copies: list[PlannedCopy], logger: SyncLogger, hashes: Optional[HashIndex] = None):
+        for copy in copies:
+            if self.cancelled:
+                return
+            with logger.timer('copy', copy.destination):
+                self._execute_copy(item, copy, logger, hashes)
+
+    def _execute_copy(self, item: SyncItem, copy: PlannedCopy, logger: SyncLogger, hashes: Optional[HashIndex] = None):
+        throttle = self._throttle(item)
+        throttle.consume_ops()
+        if copy.update and item.delta_threshold is not None and copy.size >= item.delta_threshold:
+            try:
+                written = delta_copy(copy.source, copy.destination, copy.source_stat, item.delta_block_size, throttle)
+            except Exception:
+                logger.file_error(copy.size)
+                return
+            self._remember_hash(copy.source, copy.destination, copy.source_stat, hashes)
+            logger.file_delta(written, copy.size)
+            return
+        try:
+            strategy = copy_file(copy.source, copy.destination, copy.source_stat, item.buffer_size or self.buffer_size, self._cancelled.is_set, throttle)
+        except CopyCancelled:
+            return
+        except Exception:
+            logger.file_error(copy.size)
+            return
+        self._remember_hash(copy.source, copy.destination, copy.source_stat, hashes)
+        if copy.update:
+            logger.file_updated(strategy, copy.size)
+        else:
+            logger.file_added(strategy, copy.size)
+
+    def _remember_hash(self, source_file: str, dest_file: str, source_stat: os.stat_result, hashes: Optional[HashIndex]):
+        # Only reuse a source hash that is already known; never reread a file just to index it
+        if hashes is None:
+            return
+        digest = hashes.cached(source_file, source_stat)
+        if digest is not None:
+            hashes.set(dest_file, os.stat(dest_file), digest)
 
-    def _remove_extra_files(self, source: str, destination: str, logger: SyncLogger):
-        if not os.path.exists(destination):
+    def _remove_files(self, paths: list[str], logger: SyncLogger, throttle: Throttle):
+        for path in paths:
+            throttle.consume_ops()
+            try:
+                with logger.timer('delete'):
+                    os.remove(path)
+                logger.file_deleted()
+            except Exception:
+                logger.file_error()
+
+    def _plan_listing(self, item: SyncItem, listing: DirListing, plan: SyncPlan, logger: SyncLogger, pool: FilePool, hashes: Optional[HashIndex] = None, manifest: Optional[Manifest] = None):
+        if manifest is not None and item.prune:
+            names = listing.subdirs + [entry.name for entry in listing.files]
+            if manifest.is_unchanged(listing.rel, listing.mtime_ns, names, listing.destination):
+                manifest.keep(listing.rel)
+                plan.add_ignored(len(listing.files))
+                logger.file_ignored(len(listing.files))
+                return
+
+        throttle = self._throttle(item)
+        throttle.consume_ops()
+        try:
+            with logger.timer('scan'):
+                dest_files, dest_dirs = self._list_destination(listing.destination, listing.rel, item.path_filter)
+        except FileNotFoundError:
+            plan.add_dir(listing.destination)
+            dest_files, dest_dirs = {}, []
+        except OSError:
+            logger.file_error()
             return
 
-        for entry in os.scandir(destination):
-            if entry.is_file():
-                source_file = os.path.join(source, entry.name)
-                if not os.path.exists(source_file):
-                    try:
-                        os.remove(entry.path)
-                        logger.file_deleted()
-                    except Exception:
-                        logger.file_error()
-
-    def _get_subdirectories(self, path: str) -> list[str]:
-        subdirs = []
-        for entry in os.scandir(path):
-            if entry.is_dir() and os.path.basename(entry.path) not in IGNORE_FOLDERS:
-                subdirs.append(entry.name)
-        return subdirs
+        # Merge-join source and destination listings: whatever is left in dest_files is extra
+        file_records = {}
+        for entry in listing.files:
+            dest_entry = dest_files.pop(entry.name, None)
+            if manifest is not None:
+                try:
+                    entry_stat = entry.stat()
+                except OSError:
+                    logger.file_error()
+                    continue
+                file_records[entry.name] = [entry_stat.st_size, entry_stat.st_mtime_ns]
+                if dest_entry is not None and manifest.file_unchanged(listing.rel, entry.name, entry_stat.st_size, entry_stat.st_mtime_ns) and self._dest_untouched(dest_entry, entry_stat):
+                    plan.add_ignored()
+                    logger.file_ignored()
+                    continue
+
+            dest_file = os.path.join(listing.destination, entry.name)
+            pool.submit(self._plan_entry, item, plan, entry, dest_entry, dest_file, logger, hashes)
+
+        for dest_entry in dest_files.values():
+            target = partial_target(dest_entry.name)
+            if target is not None and self._is_resumable(dest_entry.path, target, listing):
+                continue
+            plan.add_delete(dest_entry.path)
+
+        subdirs = set(listing.subdirs)
+        for name in dest_dirs:
+            if item.delete_extra_dirs and name not in subdirs and not self._is_destination(os.path.join(listing.destination, name)):
+                self._plan_extra_dir(os.path.join(listing.destination, name), os.path.join(listing.rel, name), plan, logger, item.path_filter, throttle)
+
+        if manifest is not None:
+            manifest.record(listing.rel, listing.mtime_ns, listing.subdirs, file_records)
+
+    def _dest_untouched(self, dest_entry: os.DirEntry, source_stat: os.stat_result) -> bool:
+        # Copies stamp the source size and mtime on the destination, so anything else means it
+        # was edited or damaged there and has to go through the full compare
+        try:
+            dest_stat = dest_entry.stat()
+        except OSError:
+            return False
+        return dest_stat.st_size == source_stat.st_size and dest_stat.st_mtime_ns == source_stat.st_mtime_ns
+
+    def _is_resumable(self, path: str, target: str, listing: DirListing) -> bool:
+        # An interrupted copy is kept while its source file is still there, unchanged
+        for entry in listing.files:
+            if partial_stem(entry.name) == target:
+                try:
+                    return partial_path(os.path.join(listing.destination, entry.name), entry.stat()) == path
+                except OSError:
+                    return False
+        return False
+
+    def _plan_extra_dir(self, path: str, rel: str, plan: SyncPlan, logger: SyncLogger, path_filter: PathFilter, throttle: Throttle):
+        # A destination directory with no source counterpart is emptied and removed;
+        # its files are delete candidates, so moved folders are matched by _plan_moves
+        stack = [(path, rel)]
+        while stack:
+            current, current_rel = stack.pop()
+            plan.add_extra_dir(current)
+            throttle.consume_ops()
+            try:
+                with logger.timer('scan'):
+                    files, dirs = self._list_destination(current, current_rel, path_filter)
+            except OSError:
+                logger.file_error()
+                continue
+            for entry in files.values():
+                plan.add_delete(entry.path)
+            stack.extend((os.path.join(current, name), os.path.join(current_rel, name)) for name in dirs if not self._is_destination(os.path.join(current, name)))
+
+    def _dir_key(self, path: str) -> str:
+        return os.path.normcase(os.path.abspath(path))
+
+    def _is_destination(self, path: str) -> bool:
+        return self._dir_key(path) in self._destinations
+
+    def _list_destination(self, path: str, rel: str, path_filter: PathFilter) -> tuple[dict[str, os.DirEntry], list[str]]:
+        # Excluded destination entries are not ours to manage, so they are never deleted
+        files = {}
+        dirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not path_filter.dir_excluded(os.path.join(rel, entry.name)):
+                        dirs.append(entry.name)
+                elif entry.is_file() and not path_filter.file_excluded(os.path.join(rel, entry.name)):
+                    files[entry.name] = entry
+        return files, dirs
+
+    def _walk(self, source: str, destination: str, logger: SyncLogger, path_filter: PathFilter, with_mtime: bool = False, rel: str = '', recursive: bool = True, throttle: Optional[Throttle] = None) -> Iterator[DirListing]:
+        # Iterative depth-first walk: one scandir per directory, no Python recursion.
+        # Excluded directories are dropped here, so nothing below them is ever listed.
+        stack = [(rel, source, destination)]
+        while stack and not self.cancelled:
+            rel, source_dir, dest_dir = stack.pop()
+            if throttle is not None:
+                throttle.consume_ops()
+            files = []
+            subdirs = []
+            mtime_ns = 0
+            try:
+                with logger.timer('scan'):
+                    if with_mtime:
+                        mtime_ns = os.stat(source_dir).st_mtime_ns
+                    with os.scandir(source_dir) as entries:
+                        for entry in entries:
+                            if entry.is_dir():
+                                if not path_filter.dir_excluded(os.path.join(rel, entry.name)):
+                                    subdirs.append(entry.name)
+                            elif entry.is_file() and not path_filter.file_excluded(os.path.join(rel, entry.name)):
+                                files.append(entry)
+            except OSError:
+                logger.file_error()
+                continue
+
+            for name in reversed(subdirs if recursive else []):
+                stack.append((os.path.join(rel, name), os.path.join(source_dir, name), os.path.join(dest_dir, name)))
+            yield DirListing(rel=rel, source=source_dir, destination=dest_dir, files=files, subdirs=subdirs, mtime_ns=mtime_ns)
+
+    def _dir_excluded(self, rel: str, path_filter: PathFilter) -> bool:
+        # Watch-mode changes can name any directory; skip it if it or a parent is excluded
+        return rel not in ('', os.curdir) and path_filter.dir_excluded(rel)
+
+    def _is_directory_empty(self, path: str, path_filter: PathFilter) -> bool:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if path_filter.dir_excluded(entry.name):
+                        continue
+                elif path_filter.file_excluded(entry.name):
+                    continue
+                return False
+        return True
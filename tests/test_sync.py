@@ -0,0 +1,458 @@
+import contextlib
+import io
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from copier import NAME_MAX, RESUME_THRESHOLD, THROTTLE_SEGMENT, copy_file, partial_path, partial_stem, partial_target
+import hashindex
+from filters import _translate, compile_filter
+from logger import SyncLogger
+from main import JsonReporter, run_headless
+from sync import FilePool, Sync, SyncItem, expand_destinations
+from throttle import Throttle
+
+def write(path: str, data: str, mtime_ns: int = None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+def read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = self._tmp.name
+        self.src = os.path.join(self.root, 'src')
+        self.dst = os.path.join(self.root, 'dst')
+        os.makedirs(self.src)
+        os.makedirs(self.dst)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def sync(self, *items: SyncItem, **options):
+        options.setdefault('manifest_dir', os.path.join(self.root, 'manifest'))
+        return Sync(**options).sync_items(list(items))
+
+class FilterTest(unittest.TestCase):
+    def test_globs_translate_to_component_aware_regexes(self):
+        cases = {
+            '*.txt': ('a.txt', 'd/a.txt'),
+            '**/x': ('a/b/x', 'ax'),
+            'a/**': ('a/b/c', 'b/a/c'),
+            '?.c': ('a.c', 'ab.c'),
+            '[!ab]c': ('xc', 'ac'),
+            'a\\*b': ('a*b', 'axb'),
+        }
+        for pattern, (match, miss) in cases.items():
+            with self.subTest(pattern=pattern):
+                regex = re.compile(_translate(pattern) + r'\Z')
+                self.assertIsNotNone(regex.match(match))
+                self.assertIsNone(regex.match(miss))
+
+    def test_gitignore_rules(self):
+        path_filter = compile_filter(['*.log', '!keep.log', 'build/', '/top.txt', 'docs/**/*.tmp'])
+        excluded = ['x.log', 'sub/x.log', 'build/a', 'sub/build/a', 'top.txt', 'docs/a.tmp', 'docs/x/y/a.tmp', '.git/config']
+        kept = ['keep.log', 'sub/keep.log', 'build', 'sub/top.txt', 'other/a.tmp']
+        self.assertEqual([rel for rel in excluded if not path_filter.file_excluded(rel)], [])
+        self.assertEqual([rel for rel in kept if path_filter.file_excluded(rel)], [])
+        self.assertEqual([path_filter.dir_excluded(rel) for rel in ('build', 'sub/build', '.git', 'src')], [True, True, True, False])
+
+    def test_include_keeps_only_matching_files(self):
+        path_filter = compile_filter(include=['src/', '*.py'])
+        self.assertEqual([path_filter.file_excluded(rel) for rel in ('src/a/b.c', 'lib/x.py', 'README')], [False, False, True])
+        self.assertFalse(path_filter.dir_excluded('lib'))
+
+class FilteredSyncTest(SyncTestCase):
+    def test_excluded_folders_are_neither_copied_nor_deleted(self):
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        write(os.path.join(self.src, 'node_modules', 'm.js'), 'm')
+        write(os.path.join(self.dst, 'node_modules', 'old.js'), 'old')
+
+        self.sync(SyncItem('a', self.src, self.dst, exclude=['node_modules/']))
+        self.assertEqual(sorted(os.listdir(self.dst)), ['a.txt', 'node_modules'])
+        self.assertEqual(os.listdir(os.path.join(self.dst, 'node_modules')), ['old.js'])
+
+class FilePoolTest(unittest.TestCase):
+    def test_worker_errors_reach_join(self):
+        def fail(path):
+            raise ValueError(path)
+        for workers in (1, 4):
+            with self.subTest(workers=workers), self.assertRaises(ValueError):
+                with FilePool(workers) as pool:
+                    for i in range(10):
+                        pool.submit(fail, str(i))
+                    pool.join()
+
+class MoveDetectionTest(SyncTestCase):
+    def test_renamed_folder_is_moved(self):
+        write(os.path.join(self.src, 'old', 'a.txt'), 'AAAA')
+        self.sync(SyncItem('a', self.src, self.dst))
+        inode = os.stat(os.path.join(self.dst, 'old', 'a.txt')).st_ino
+        os.rename(os.path.join(self.src, 'old'), os.path.join(self.src, 'new'))
+
+        plans = self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual(len(plans[0].moves), 1)
+        self.assertEqual(os.stat(os.path.join(self.dst, 'new', 'a.txt')).st_ino, inode)
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'old')))
+
+    def test_same_size_and_mtime_is_not_a_move(self):
+        mtime_ns = 1_600_000_000_000_000_000
+        write(os.path.join(self.src, 'old', 'a.txt'), 'AAAA', mtime_ns)
+        self.sync(SyncItem('a', self.src, self.dst))
+        os.remove(os.path.join(self.src, 'old', 'a.txt'))
+        write(os.path.join(self.src, 'new', 'b.txt'), 'BBBB', mtime_ns)
+
+        plans = self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual(plans[0].moves, [])
+        self.assertEqual(read(os.path.join(self.dst, 'new', 'b.txt')), 'BBBB')
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'old', 'a.txt')))
+
+    def test_ambiguous_candidates_are_copied(self):
+        mtime_ns = 1_600_000_000_000_000_000
+        write(os.path.join(self.src, 'old', 'a.txt'), 'AAAA', mtime_ns)
+        write(os.path.join(self.src, 'old2', 'a.txt'), 'CCCC', mtime_ns)
+        self.sync(SyncItem('a', self.src, self.dst))
+        for name in ('old', 'old2'):
+            os.remove(os.path.join(self.src, name, 'a.txt'))
+        write(os.path.join(self.src, 'new', 'a.txt'), 'CCCC', mtime_ns)
+
+        plans = self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual(plans[0].moves, [])
+        self.assertEqual(read(os.path.join(self.dst, 'new', 'a.txt')), 'CCCC')
+
+class ManifestTest(SyncTestCase):
+    def test_warm_run_ignores_unchanged_files(self):
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        self.sync(SyncItem('a', self.src, self.dst))
+        plans = self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual((plans[0].copies, plans[0].ignored), ([], 1))
+
+    def test_damaged_destination_is_repaired(self):
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        self.sync(SyncItem('a', self.src, self.dst))
+        write(os.path.join(self.dst, 'a.txt'), '0123456789')
+
+        self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual(read(os.path.join(self.dst, 'a.txt')), 'a')
+
+    def test_pruned_directory_is_skipped_until_it_changes(self):
+        write(os.path.join(self.src, 'd', 'a.txt'), 'a')
+        self.sync(SyncItem('a', self.src, self.dst, prune=True))
+        plans = self.sync(SyncItem('a', self.src, self.dst, prune=True))
+        self.assertEqual(plans[0].ignored, 1)
+
+        write(os.path.join(self.src, 'd', 'b.txt'), 'b')
+        plans = self.sync(SyncItem('a', self.src, self.dst, prune=True))
+        self.assertEqual([os.path.basename(copy.destination) for copy in plans[0].copies], ['b.txt'])
+
+    def test_file_removed_from_pruned_directory_is_deleted(self):
+        write(os.path.join(self.src, 'd', 'a.txt'), 'a')
+        write(os.path.join(self.src, 'd', 'b.txt'), 'b')
+        self.sync(SyncItem('a', self.src, self.dst, prune=True))
+        os.remove(os.path.join(self.src, 'd', 'b.txt'))
+
+        plans = self.sync(SyncItem('a', self.src, self.dst, prune=True))
+        self.assertEqual(plans[0].deletes, [os.path.join(self.dst, 'd', 'b.txt')])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dst, 'd'))), ['a.txt'])
+
+    def test_changed_source_file_is_copied(self):
+        write(os.path.join(self.src, 'a.txt'), 'a', 1_600_000_000_000_000_000)
+        self.sync(SyncItem('a', self.src, self.dst))
+        write(os.path.join(self.src, 'a.txt'), 'b', 1_700_000_000_000_000_000)
+
+        plans = self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual(len(plans[0].copies), 1)
+        self.assertEqual(read(os.path.join(self.dst, 'a.txt')), 'b')
+
+class RecordingExporter:
+    def __init__(self):
+        self.stats = {}
+
+    def export(self, item_name, stats, metrics):
+        self.stats[item_name] = stats
+
+class DeltaTest(SyncTestCase):
+    def test_only_changed_blocks_are_written(self):
+        block_size = 4096
+        data = bytearray(os.urandom(16 * block_size))
+        source = os.path.join(self.src, 'image')
+        with open(source, 'wb') as f:
+            f.write(data)
+        item = SyncItem('a', self.src, self.dst, delta_threshold=0, delta_block_size=block_size)
+        self.sync(item)
+
+        data[5 * block_size + 10] ^= 0xFF
+        with open(source, 'wb') as f:
+            f.write(data)
+        os.utime(source, ns=(1_700_000_000_000_000_000, 1_700_000_000_000_000_000))
+        exporter = RecordingExporter()
+        self.sync(item, metrics_exporter=exporter)
+        self.assertEqual((exporter.stats['a'].delta_written, exporter.stats['a'].delta_size), (block_size, len(data)))
+        with open(os.path.join(self.dst, 'image'), 'rb') as f:
+            self.assertTrue(f.read() == data)
+
+    def test_shrunk_file_is_truncated(self):
+        write(os.path.join(self.src, 'f'), 'A' * 10000)
+        item = SyncItem('a', self.src, self.dst, delta_threshold=0, delta_block_size=4096)
+        self.sync(item)
+        write(os.path.join(self.src, 'f'), 'A' * 5000, 1_700_000_000_000_000_000)
+
+        self.sync(item)
+        self.assertEqual(read(os.path.join(self.dst, 'f')), 'A' * 5000)
+
+class HashIndexTest(SyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hashed = []
+        file_hash = hashindex.file_hash
+        def counting_hash(path: str) -> str:
+            self.hashed.append(path)
+            return file_hash(path)
+        hashindex.file_hash = counting_hash
+        self.addCleanup(setattr, hashindex, 'file_hash', file_hash)
+
+    def test_index_survives_runs_that_hash_nothing(self):
+        mtime_ns = 1_600_000_000_000_000_000
+        for i in range(4):
+            write(os.path.join(self.src, 'sub', f'f{i}'), f'data{i}', mtime_ns)
+            write(os.path.join(self.dst, 'sub', f'f{i}'), f'data{i}', mtime_ns + 120 * 10 ** 9)
+        item = SyncItem('a', self.src, self.dst, compare='hash', prune=True)
+        plans = self.sync(item)
+        self.assertEqual((plans[0].copies, len(self.hashed)), ([], 8))
+        # The manifest prunes the unchanged folder, so this run looks up no hashes at all
+        self.sync(item)
+
+        write(os.path.join(self.src, 'sub', 'new'), 'new')
+        self.hashed.clear()
+        plans = self.sync(item)
+        self.assertEqual([copy.source for copy in plans[0].copies], [os.path.join(self.src, 'sub', 'new')])
+        self.assertEqual(self.hashed, [])
+
+    def test_changed_content_is_copied(self):
+        mtime_ns = 1_600_000_000_000_000_000
+        write(os.path.join(self.src, 'f'), 'AAAA', mtime_ns)
+        write(os.path.join(self.dst, 'f'), 'BBBB', mtime_ns)
+        self.sync(SyncItem('a', self.src, self.dst, compare='hash'))
+        self.assertEqual(read(os.path.join(self.dst, 'f')), 'AAAA')
+
+class ExtraDirTest(SyncTestCase):
+    def test_extra_dir_is_removed(self):
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        write(os.path.join(self.dst, 'gone', 'x.txt'), 'x')
+        self.sync(SyncItem('a', self.src, self.dst))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'gone')))
+
+    def test_extra_dirs_can_be_kept(self):
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        write(os.path.join(self.dst, 'kept', 'x.txt'), 'x')
+        self.sync(SyncItem('a', self.src, self.dst, delete_extra_dirs=False))
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'kept', 'x.txt')))
+
+    def test_nested_destination_is_left_alone(self):
+        other = os.path.join(self.root, 'other')
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        write(os.path.join(other, 'c.txt'), 'c')
+        os.makedirs(os.path.join(self.dst, 'c'))
+        items = [SyncItem('a', self.src, self.dst), SyncItem('c', other, os.path.join(self.dst, 'c'))]
+        self.sync(*items)
+        plans = self.sync(*items)
+        self.assertEqual([plan.deletes for plan in plans], [[], []])
+        self.assertEqual(plans[1].ignored, 1)
+        self.assertEqual(read(os.path.join(self.dst, 'c', 'c.txt')), 'c')
+
+    def test_nested_destination_of_unselected_item_is_left_alone(self):
+        other = os.path.join(self.root, 'other')
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        write(os.path.join(other, 'c.txt'), 'c')
+        os.makedirs(os.path.join(self.dst, 'c'))
+        item_a = SyncItem('a', self.src, self.dst)
+        item_c = SyncItem('c', other, os.path.join(self.dst, 'c'))
+        sync = Sync(manifest_dir=os.path.join(self.root, 'manifest'))
+        sync.protect_destinations([item_a, item_c])
+        sync.sync_items([item_a, item_c])
+
+        plans = sync.sync_items([item_a])
+        self.assertEqual(plans[0].deletes, [])
+        self.assertEqual(read(os.path.join(self.dst, 'c', 'c.txt')), 'c')
+
+class PartialFileTest(SyncTestCase):
+    def test_long_name_is_copied(self):
+        name = 'n' * 244 + '.txt'
+        write(os.path.join(self.src, name), 'long')
+        plans = self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual(plans[0].errors, 0)
+        self.assertEqual(read(os.path.join(self.dst, name)), 'long')
+
+    def test_long_partial_name_fits_and_maps_back(self):
+        name = 'n' * 250
+        write(os.path.join(self.src, name), 'long')
+        partial = partial_path(os.path.join(self.dst, name), os.stat(os.path.join(self.src, name)))
+        self.assertLessEqual(len(os.path.basename(partial)), NAME_MAX)
+        self.assertEqual(partial_target(os.path.basename(partial)), partial_stem(name))
+        self.assertNotEqual(partial_stem(name), partial_stem('n' * 251))
+
+        write(partial, 'lo')
+        plans = Sync(manifest_dir=os.path.join(self.root, 'manifest')).plan_items([SyncItem('a', self.src, self.dst)])
+        self.assertEqual(plans[0].deletes, [])
+
+class FileListTest(SyncTestCase):
+    def test_overlapping_entries_copy_once(self):
+        write(os.path.join(self.src, 'a.log'), 'a')
+        write(os.path.join(self.src, 'b.log'), 'b')
+        source = [os.path.join(self.src, 'a.log'), os.path.join(self.src, '*.log'), os.path.join(self.src, '?.log')]
+        plans = self.sync(SyncItem('l', source, self.dst), workers=4)
+        self.assertEqual(sorted(os.path.basename(copy.source) for copy in plans[0].copies), ['a.log', 'b.log'])
+        self.assertEqual(plans[0].errors, 0)
+
+    def test_collision_is_kept_out_of_watch_runs(self):
+        first = os.path.join(self.src, 'l1', 'f.txt')
+        second = os.path.join(self.src, 'l2', 'f.txt')
+        write(first, 'one')
+        write(second, 'two')
+        item = SyncItem('l', [first, second], self.dst)
+        sync = Sync(manifest_dir=os.path.join(self.root, 'manifest'))
+        plans = sync.sync_items([item])
+        self.assertEqual(plans[0].collisions, [second])
+        self.assertEqual(read(os.path.join(self.dst, 'f.txt')), 'one')
+
+        write(second, 'two, edited')
+        sync.sync_changes(item, {second: False}, SyncLogger())
+        self.assertEqual(read(os.path.join(self.dst, 'f.txt')), 'one')
+
+class MissingSourceTest(SyncTestCase):
+    def test_missing_source_fails_only_its_item(self):
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        other = os.path.join(self.root, 'other')
+        os.makedirs(other)
+        plans = self.sync(SyncItem('missing', os.path.join(self.root, 'nosuch'), other), SyncItem('a', self.src, self.dst))
+        self.assertEqual([(plan.name, plan.errors) for plan in plans], [('missing', 1), ('a', 0)])
+        self.assertEqual(read(os.path.join(self.dst, 'a.txt')), 'a')
+
+class RecordingThrottle(Throttle):
+    def __init__(self):
+        super().__init__()
+        self.consumed = []
+
+    def consume_bytes(self, count: int):
+        self.consumed.append(count)
+
+class ResumeTest(SyncTestCase):
+    def test_damaged_partial_prefix_is_recopied(self):
+        source = os.path.join(self.src, 'big')
+        data = os.urandom(RESUME_THRESHOLD + 1)
+        with open(source, 'wb') as f:
+            f.write(data)
+        dest = os.path.join(self.dst, 'big')
+        damaged = bytearray(data[:30 * 1024 * 1024])
+        damaged[100] ^= 0xFF
+        with open(partial_path(dest, os.stat(source)), 'wb') as f:
+            f.write(damaged)
+
+        plans = self.sync(SyncItem('a', self.src, self.dst))
+        self.assertEqual(plans[0].errors, 0)
+        with open(dest, 'rb') as f:
+            self.assertTrue(f.read() == data)
+
+    def test_intact_partial_is_resumed(self):
+        source = os.path.join(self.src, 'big')
+        data = os.urandom(RESUME_THRESHOLD + 1)
+        with open(source, 'wb') as f:
+            f.write(data)
+        dest = os.path.join(self.dst, 'big')
+        with open(partial_path(dest, os.stat(source)), 'wb') as f:
+            f.write(data[:30 * 1024 * 1024])
+
+        self.assertEqual(copy_file(source, dest, os.stat(source)), 'resumed')
+        with open(dest, 'rb') as f:
+            self.assertTrue(f.read() == data)
+
+class ThrottleTest(SyncTestCase):
+    def test_cap_set_during_copy_applies(self):
+        source = os.path.join(self.src, 'big')
+        with open(source, 'wb') as f:
+            f.truncate(RESUME_THRESHOLD + 1)
+        throttle = RecordingThrottle()
+        # The cancel check runs before every segment; setting the cap there mimics a change mid-copy
+        cancelled = lambda: throttle.bandwidth.set_rate(1 << 40) or False
+        strategy = copy_file(source, os.path.join(self.dst, 'big'), os.stat(source), cancelled=cancelled, throttle=throttle)
+        if strategy == 'reflink':
+            self.skipTest("reflinks move no data")
+        self.assertEqual(sum(throttle.consumed), RESUME_THRESHOLD + 1)
+        self.assertEqual(max(throttle.consumed), THROTTLE_SEGMENT)
+
+    def test_item_caps_follow_source_and_destination(self):
+        sync = Sync(manifest_dir=os.path.join(self.root, 'manifest'))
+        first = SyncItem('docs', os.path.join(self.root, 'a'), self.dst)
+        second = SyncItem('docs', os.path.join(self.root, 'b'), self.dst)
+        self.assertIsNot(sync._throttle(first), sync._throttle(second))
+
+        expanded = expand_destinations([SyncItem('docs', self.src, [self.dst, os.path.join(self.root, 'other')])])
+        sync.set_bandwidth(1024, item='docs')
+        self.assertEqual([sync._throttle(item).bandwidth.rate for item in expanded], [1024, 1024])
+        self.assertEqual(sync._throttle(first).bandwidth.rate, 1024)
+
+class CancellingReporter(JsonReporter):
+    def __init__(self, sync: Sync):
+        super().__init__(interval=0)
+        self.sync = sync
+
+    def progress(self, current: str, total: str):
+        self.sync.cancel()
+        super().progress(current, total)
+
+class CommandLineTest(SyncTestCase):
+    def run_main(self, *args: str) -> tuple[int, list[dict]]:
+        config = os.path.join(self.root, 'config.json')
+        with open(config, 'w', encoding='utf-8') as f:
+            json.dump({'g': {'a': [self.src, self.dst]}}, f)
+        main_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+        result = subprocess.run([sys.executable, main_path, '--config', config, *args], cwd=self.root, capture_output=True, text=True)
+        return result.returncode, [json.loads(line) for line in result.stdout.splitlines()]
+
+    def test_successful_run(self):
+        write(os.path.join(self.src, 'a.txt'), 'a')
+        code, events = self.run_main('--json', '--item', 'g/a')
+        self.assertEqual(code, 0)
+        self.assertEqual(events[-1]['event'], 'result')
+        self.assertEqual(events[-1]['exit_code'], 0)
+        self.assertEqual([(item['name'], item['copied'], item['errors']) for item in events[-1]['items']], [('a', 1, 0)])
+
+    def test_missing_destination_is_an_error(self):
+        os.rmdir(self.dst)
+        code, events = self.run_main('--json', '--group', 'g')
+        self.assertEqual(code, 1)
+        self.assertEqual([event['event'] for event in events if event['event'] != 'log'][0], 'error')
+        self.assertEqual(events[-1]['exit_code'], 1)
+
+    def test_unknown_item_is_a_usage_error(self):
+        code, events = self.run_main('--json', '--item', 'nope')
+        self.assertEqual((code, events), (2, []))
+
+    def test_cancelled_run(self):
+        for i in range(20):
+            write(os.path.join(self.src, f'f{i}'), 'x')
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        sync = Sync(manifest_dir=os.path.join(self.root, 'manifest'))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            code = run_headless(sync, [SyncItem('a', self.src, self.dst)], CancellingReporter(sync))
+        result = json.loads(output.getvalue().splitlines()[-1])
+        self.assertEqual((code, result['exit_code'], result['items'][0]['cancelled']), (130, 130, True))
+        self.assertLess(len(os.listdir(self.dst)), 20)
+
+if __name__ == '__main__':
+    unittest.main()
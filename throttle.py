@@ -0,0 +1,101 @@
+from typing import Optional
+import ctypes
+import os
+import platform
+import sys
+import threading
+import time
+
+MAX_WAIT = 0.1
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+THREAD_MODE_BACKGROUND_BEGIN = 0x00010000
+
+_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+
+class TokenBucket:
+    # At most `rate` units per second on average, with bursts of up to one second's worth.
+    # Waits are sliced into short sleeps, so a new rate applies to callers already waiting.
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate or None
+        self.tokens = float(rate or 0)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate: Optional[float]):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate or None
+            if self.rate is not None:
+                self.tokens = min(self.tokens, self.rate)
+
+    def consume(self, amount: float):
+        while self.rate is not None:
+            with self._lock:
+                if self.rate is None:
+                    return
+                self._refill(time.monotonic())
+                # Requests larger than a burst go into debt instead of waiting forever
+                needed = min(amount, self.rate)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(min(wait, MAX_WAIT))
+
+    def _refill(self, now: float):
+        if self.rate is not None:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class Throttle:
+    # Bandwidth (bytes/s) and IOPS caps; an item's throttle also draws from the global one
+    def __init__(self, bandwidth: Optional[float] = None, iops: Optional[float] = None, parent: Optional['Throttle'] = None):
+        self.bandwidth = TokenBucket(bandwidth)
+        self.iops = TokenBucket(iops)
+        self.parent = parent
+
+    @property
+    def limits_bandwidth(self) -> bool:
+        if self.bandwidth.rate is not None:
+            return True
+        return self.parent is not None and self.parent.limits_bandwidth
+
+    def consume_bytes(self, count: int):
+        self.bandwidth.consume(count)
+        if self.parent is not None:
+            self.parent.consume_bytes(count)
+
+    def consume_ops(self, count: int = 1):
+        self.iops.consume(count)
+        if self.parent is not None:
+            self.parent.consume_ops(count)
+
+def lower_priority():
+    # Idle I/O class and lowest CPU priority for the calling thread, as far as the platform allows
+    if sys.platform.startswith('win'):
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetThreadPriority(kernel32.GetCurrentThread(), THREAD_MODE_BACKGROUND_BEGIN)
+        return
+    if sys.platform.startswith('linux'):
+        number = _IOPRIO_SET.get(platform.machine())
+        if number is not None:
+            try:
+                ctypes.CDLL(None, use_errno=True).syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+            except (OSError, AttributeError):
+                pass
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(19)
+        except OSError:
+            pass
+
+def parse_rate(text: str) -> Optional[float]:
+    # '0' or '' means unlimited; K, M and G suffixes are binary multiples
+    text = text.strip().upper()
+    if not text:
+        return None
+    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(text[-1])
+    value = float(text[:-1] if multiplier else text) * (multiplier or 1)
+    return value or None
@@ -0,0 +1,284 @@
+from typing import Optional, Callable
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import os
+import select
+import struct
+import sys
+import time
+from logger import SyncLogger
+from filters import PathFilter
+from sync import Sync, SyncItem, iter_file_list
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifySource:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add_tree(self, path: str, key: tuple[int, str], path_filter: PathFilter):
+        # Watch path and every subdirectory below it; key is (item index, relative dir)
+        index, rel = key
+        stack = [(path, rel)]
+        while stack:
+            current, current_rel = stack.pop()
+            wd = self._add_watch(self.fd, os.fsencode(current), WATCH_MASK)
+            if wd < 0:
+                continue
+            self._register(wd, index, current_rel)
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and not path_filter.dir_excluded(os.path.join(current_rel, entry.name)):
+                            stack.append((entry.path, os.path.join(current_rel, entry.name)))
+            except OSError:
+                pass
+
+    def add_file(self, path: str, index: int):
+        # Directory of a file-list item; events carry the directory itself as their rel
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self._register(wd, index, path)
+
+    def rel(self, wd: int, index: int) -> Optional[str]:
+        for target_index, rel in self.watches.get(wd, []):
+            if target_index == index:
+                return rel
+        return None
+
+    def remove(self, wd: int):
+        if self.watches.pop(wd, None) is not None:
+            self._rm_watch(self.fd, wd)
+
+    def _register(self, wd: int, index: int, rel: str):
+        # The kernel returns the same descriptor when several items watch one directory
+        targets = self.watches.setdefault(wd, [])
+        targets[:] = [target for target in targets if target[0] != index]
+        targets.append((index, rel))
+
+    def read(self, timeout: Optional[float]) -> Optional[list[tuple[int, int, str, int, str]]]:
+        # Returns (watch descriptor, item index, relative dir, mask, name) tuples, or None on queue overflow
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        data = self._read_all()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            for index, rel in self.watches.get(wd, []):
+                events.append((wd, index, rel, mask, name))
+        return events
+
+    def _read_all(self) -> bytes:
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    def __init__(self, sync: Sync, items: list[SyncItem], debounce: float = 0.5, max_delay: float = 5.0, poll_interval: float = 2.0):
+        self.sync = sync
+        self.items = items
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.running = False
+        self._file_lists = {}
+
+    def run(self, progress_callback: Optional[Callable[[str, str], None]] = None, log_callback: Optional[Callable[[str, bool, Optional[str]], None]] = None):
+        self.running = True
+        self.sync.sync_items(self.items, progress_callback, log_callback)
+        logger = SyncLogger(progress_callback, log_callback)
+
+        if sys.platform.startswith('linux'):
+            try:
+                source = InotifySource()
+            except (OSError, AttributeError):
+                source = None
+            if source is not None:
+                try:
+                    self._run_inotify(source, logger)
+                finally:
+                    source.close()
+                return
+        self._run_polling(logger)
+
+    def stop(self):
+        self.running = False
+        self.sync.cancel()
+
+    def _run_inotify(self, source: InotifySource, logger: SyncLogger):
+        for index, item in enumerate(self.items):
+            if isinstance(item.source, list):
+                for directory in {os.path.dirname(os.path.abspath(path)) for path in item.source}:
+                    for match in (glob.iglob(directory) if glob.has_magic(directory) else [directory]):
+                        source.add_file(match, index)
+            else:
+                source.add_tree(item.source, (index, ''), item.path_filter)
+
+        while self.running:
+            events = source.read(1.0)
+            if not events:
+                if events is None:
+                    self.sync.sync_items(self.items, logger.progress_callback, logger.log_callback)
+                continue
+
+            # Coalesce everything that arrives until the tree has been quiet for `debounce`
+            changes = {}
+            first_event = time.monotonic()
+            while events:
+                self._collect(source, events, changes)
+                remaining = self.max_delay - (time.monotonic() - first_event)
+                if remaining <= 0:
+                    break
+                events = source.read(min(self.debounce, remaining))
+                if events is None:
+                    changes = {index: {'': True} for index in range(len(self.items))}
+                    break
+            self._apply(changes, logger)
+
+    def _collect(self, source: InotifySource, events: list, changes: dict[int, dict[str, bool]]):
+        for wd, index, rel, mask, name in events:
+            item = self.items[index]
+            item_changes = changes.setdefault(index, {})
+            if isinstance(item.source, list):
+                path = os.path.join(rel, name)
+                if self._listed(index, path):
+                    item_changes[path] = False
+                continue
+            if mask & IN_DELETE_SELF:
+                source.remove(wd)
+                continue
+            if mask & IN_MOVE_SELF:
+                # Arrives after the parent's IN_MOVED_TO, which has re-added the directory under its
+                # new name with the same descriptor; only a directory moved out of the tree is dropped
+                current = source.rel(wd, index)
+                if current is None or not os.path.isdir(os.path.join(item.source, current)):
+                    source.remove(wd)
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not item.path_filter.dir_excluded(os.path.join(rel, name)):
+                child = os.path.join(rel, name)
+                source.add_tree(os.path.join(item.source, child), (index, child), item.path_filter)
+                item_changes[child] = True
+            item_changes.setdefault(rel, False)
+
+    def _listed(self, index: int, path: str) -> bool:
+        # Literal paths are a set lookup; only glob patterns are matched one by one
+        if index not in self._file_lists:
+            paths = [os.path.abspath(path) for path in self.items[index].source]
+            self._file_lists[index] = ({path for path in paths if not glob.has_magic(path)}, [os.path.split(path) for path in paths if glob.has_magic(path)])
+        literal, patterns = self._file_lists[index]
+        if path in literal:
+            return True
+        directory, name = os.path.split(path)
+        return any(fnmatch.fnmatch(name, pattern_name) and fnmatch.fnmatch(directory, pattern_dir) for pattern_dir, pattern_name in patterns)
+
+    def _run_polling(self, logger: SyncLogger):
+        snapshots = [self._snapshot(item) for item in self.items]
+        while self.running:
+            time.sleep(self.poll_interval)
+            changes = {}
+            for index, item in enumerate(self.items):
+                snapshot = self._snapshot(item)
+                changed = {key: False for key in snapshot.keys() | snapshots[index].keys() if snapshot.get(key) != snapshots[index].get(key)}
+                if not isinstance(item.source, list):
+                    changed = {self._existing_parent(key, snapshot): False for key in changed}
+                if changed:
+                    changes[index] = changed
+                snapshots[index] = snapshot
+            self._apply(changes, logger)
+
+    def _existing_parent(self, rel: str, snapshot: dict) -> str:
+        # A directory that disappeared is removed from the destination by a sync of its parent
+        while rel and rel not in snapshot:
+            rel = os.path.dirname(rel)
+        return rel
+
+    def _snapshot(self, item: SyncItem) -> dict:
+        # File lists map path -> (size, mtime); directories map rel dir -> sorted file stats
+        snapshot = {}
+        if isinstance(item.source, list):
+            for path in iter_file_list(item.source):
+                try:
+                    file_stat = os.stat(path)
+                    snapshot[path] = (file_stat.st_size, file_stat.st_mtime_ns)
+                except OSError:
+                    snapshot[path] = None
+            return snapshot
+
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            files = []
+            try:
+                with os.scandir(os.path.join(item.source, rel)) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            if not item.path_filter.dir_excluded(os.path.join(rel, entry.name)):
+                                stack.append(os.path.join(rel, entry.name))
+                        elif entry.is_file() and not item.path_filter.file_excluded(os.path.join(rel, entry.name)):
+                            entry_stat = entry.stat()
+                            files.append((entry.name, entry_stat.st_size, entry_stat.st_mtime_ns))
+            except OSError:
+                continue
+            snapshot[rel] = tuple(sorted(files))
+        return snapshot
+
+    def _apply(self, changes: dict[int, dict[str, bool]], logger: SyncLogger):
+        for index, item_changes in changes.items():
+            item = self.items[index]
+            if not isinstance(item.source, list):
+                item_changes = self._coalesce(item_changes)
+            if item_changes:
+                self.sync.sync_changes(item, item_changes, logger)
+
+    def _coalesce(self, item_changes: dict[str, bool]) -> dict[str, bool]:
+        # Drop directories already covered by a recursive change of one of their parents
+        recursive = [rel for rel, deep in item_changes.items() if deep]
+        result = {}
+        for rel, deep in item_changes.items():
+            covered = any(rel != parent and (parent == '' or rel.startswith(parent + os.sep)) for parent in recursive)
+            if not covered:
+                result[rel] = deep
+        return result